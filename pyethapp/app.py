@@ -29,7 +29,7 @@ import utils
 from accounts import AccountsService, Account
 from console_service import Console
 from db_service import DBService
-from eth_service import ChainService
+from eth_service import ChainService, CompactBlocksService
 from jsonrpc import JSONRPCServer, IPCRPCServer
 from pow_service import PoWService
 from validator_service import ValidatorService
@@ -41,7 +41,7 @@ from pyethapp.utils import merge_dict, load_contrib_services, FallbackChoice, en
 log = slogging.get_logger('app')
 
 services = [DBService, AccountsService, NodeDiscovery, PeerManager, ChainService,
-            PoWService, JSONRPCServer, IPCRPCServer, Console]
+            CompactBlocksService, PoWService, JSONRPCServer, IPCRPCServer, Console]
 
 
 class EthApp(BaseApp):
@@ -159,6 +159,8 @@ def app(ctx, profile, alt_config, config_values, alt_data_dir, log_config, boots
         config['pow']['cpu_pct'] = int(min(100, mining_pct))
     if not config.get('pow', {}).get('activated'):
         config['deactivated_services'].append(PoWService.name)
+    if not config['eth']['block_relay']['compact']:
+        config['deactivated_services'].append(CompactBlocksService.name)
 
     if join_validators:
         privkey = decode_hex(config['validator']['privkey_hex'])
@@ -470,7 +472,7 @@ def import_blocks(ctx, file):
     AccountsService.register_with_app(app)
     ChainService.register_with_app(app)
     chain = app.services.chain
-    assert chain.block_queue.empty()
+    assert chain.block_pipeline.idle
 
     data = file.read()
     app.start()
@@ -505,21 +507,45 @@ def import_blocks(ctx, file):
                   first_unknown_block=first_block.header.number)
         sys.exit(1)
 
-    # import all blocks
-    for n, block in enumerate(blocks()):
-        if block is None:
-            log.warning('skipping block', number_in_file=n)
-            continue
+    # import all blocks, seals are checked in batches
+    for n, block in blocks_with_valid_seals(chain, blocks()):
         log.debug('adding block to queue', number_in_file=n, number_in_chain=block.header.number)
-        app.services.chain.add_block(block, None)  # None for proto
+        chain.add_block(block, None)  # None for proto
 
     # let block processing finish
-    while not app.services.chain.block_queue.empty():
+    while not app.services.chain.block_pipeline.idle:
         gevent.sleep()
     app.stop()
     log.info('import finished', head_number=app.services.chain.chain.head.number)
 
 
+def blocks_with_valid_seals(chain, blocks, batch_size=64):
+    """
+    Yields `(number_in_file, block)` for the blocks that could be decoded and have
+    a valid seal. The seals of `batch_size` blocks are checked at once.
+    """
+    batch = []
+    for n, block in enumerate(blocks):
+        if block is None:
+            log.warning('skipping block', number_in_file=n)
+            continue
+        batch.append((n, block))
+        if len(batch) == batch_size:
+            for item in _with_valid_seals(chain, batch):
+                yield item
+            batch = []
+    for item in _with_valid_seals(chain, batch):
+        yield item
+
+
+def _with_valid_seals(chain, batch):
+    for (n, block), valid in zip(batch, chain.check_seals([b.header for _, b in batch])):
+        if valid:
+            yield n, block
+        else:
+            log.warning('invalid seal, skipping block', number_in_file=n)
+
+
 @app.group()
 @click.pass_context
 def account(ctx):
@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+"""
+Caches for serving blocks to peers. Entries are kept rlp encoded, as sliced
+from the stored blocks, so replies are assembled without decoding or encoding.
+"""
+from collections import OrderedDict
+
+import rlp
+from ethereum.slogging import get_logger
+from ethereum.utils import big_endian_to_int
+
+from pyethapp.eth_protocol import rlp_list_items, encode_raw_list
+
+log = get_logger('eth.cache')
+
+
+class HeaderCache(object):
+
+    """
+    LRU of the encoded headers of the canonical chain, indexed by number and
+    hash. Misses are read from the chain db. The cache is cleared whenever the
+    new head doesn't extend the previous one.
+    """
+
+    header_number_index = 8  # position of the number in the encoded header
+
+    def __init__(self, chain, size=2048):
+        self.chain = chain
+        self.size = size
+        self.headers = OrderedDict()  # number: (hash, header_rlp)
+        self.numbers = dict()  # hash: number
+        self.head_hash = chain.head_hash
+
+    def __len__(self):
+        return len(self.headers)
+
+    def clear(self):
+        self.headers.clear()
+        self.numbers.clear()
+
+    def load(self, blockhash):
+        "returns the encoded header of `blockhash` or None"
+        try:
+            block_rlp = self.chain.db.get(blockhash)
+        except KeyError:
+            return None
+        if block_rlp == 'GENESIS':
+            return rlp.encode(self.chain.get_block(blockhash).header)
+        return rlp_list_items(block_rlp)[0]
+
+    def _add(self, number, blockhash, header_rlp):
+        self.headers.pop(number, None)
+        self.headers[number] = (blockhash, header_rlp)
+        self.numbers[blockhash] = number
+        if len(self.headers) > self.size:
+            _, (h, _) = self.headers.popitem(last=False)
+            del self.numbers[h]
+
+    def blockhash_of(self, number):
+        "returns the hash of the canonical block `number` or None"
+        try:
+            return self.chain.get_blockhash_by_number(number)
+        except KeyError:  # beyond the head
+            return None
+
+    def get(self, number):
+        "returns the encoded header of the canonical block `number` or None"
+        entry = self.headers.pop(number, None)
+        if entry is None:
+            blockhash = self.blockhash_of(number)
+            header_rlp = self.load(blockhash) if blockhash else None
+            if header_rlp is None:
+                return None
+            self._add(number, blockhash, header_rlp)
+        else:
+            self.headers[number] = entry  # most recently used
+        return self.headers[number][1]
+
+    def number_of(self, blockhash):
+        "returns the number of `blockhash` if it's in the canonical chain, else None"
+        if blockhash in self.numbers:
+            return self.numbers[blockhash]
+        header_rlp = self.load(blockhash)
+        if header_rlp is None:
+            return None
+        number = big_endian_to_int(rlp.decode(header_rlp)[self.header_number_index])
+        if self.blockhash_of(number) != blockhash:
+            return None  # not canonical
+        self._add(number, blockhash, header_rlp)
+        return number
+
+    def on_new_head(self, block):
+        if block.header.hash != self.chain.head_hash:
+            return  # added to a side chain
+        if block.header.prevhash != self.head_hash:  # reorg
+            log.debug('clearing header cache', size=len(self))
+            self.clear()
+        self.head_hash = block.header.hash
+        self._add(block.header.number, block.header.hash, rlp.encode(block.header))
+
+    def range(self, origin, amount, skip=0, reverse=False):
+        "returns up to `amount` encoded headers, every `skip + 1`th from `origin`"
+        step = -(skip + 1) if reverse else skip + 1
+        headers = []
+        for number in xrange(origin, origin + step * amount, step):
+            if number < 0:
+                break
+            header_rlp = self.get(number)
+            if header_rlp is None:
+                break
+            headers.append(header_rlp)
+        return headers
+
+
+class BodyCache(object):
+
+    """
+    LRU of encoded block bodies, `[transactions, uncles]`, by block hash.
+    Bodies are sliced from the stored block rlp, many peers syncing the same
+    range are served from memory.
+    """
+
+    def __init__(self, chain, size=256):
+        self.chain = chain
+        self.size = size
+        self.bodies = OrderedDict()  # hash: body_rlp
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def load(self, blockhash):
+        "returns the encoded body of `blockhash` or None"
+        try:
+            block_rlp = self.chain.db.get(blockhash)
+        except KeyError:
+            return None
+        if block_rlp == 'GENESIS':
+            block = self.chain.get_block(blockhash)
+            return rlp.encode([block.transactions, block.uncles])
+        return encode_raw_list(rlp_list_items(block_rlp)[1:])
+
+    def get(self, blockhash):
+        body_rlp = self.bodies.pop(blockhash, None)
+        if body_rlp is None:
+            body_rlp = self.load(blockhash)
+            if body_rlp is None:
+                return None
+            if len(self.bodies) >= self.size:
+                self.bodies.popitem(last=False)
+        self.bodies[blockhash] = body_rlp
+        return body_rlp
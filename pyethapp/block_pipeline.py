@@ -0,0 +1,378 @@
+# -*- coding: utf8 -*-
+"""
+Staged processing of the blocks handed to `ChainService.add_block`.
+
+    block_queue -> decode -> check -> senders -> prefetch -> execute -> post
+
+Every stage runs in its own greenlet and passes blocks on through a bounded
+queue, so decoding, seal checks and signature recovery of the next blocks
+overlap with the execution of the current one. Blocks leave the pipeline in the
+order they were added. Signature recovery can be moved to worker processes
+(`eth.block_pipeline.sender_workers`). The state a block is going to touch is
+read from the db in the background before it is executed
+(`eth.block_pipeline.prefetch`).
+
+The latency of every stage and of the time blocks spend waiting in between is
+recorded in streaming histograms, see `BlockPipeline.stats`.
+"""
+import time
+
+import gevent
+import gipc
+import rlp
+from gevent.queue import Queue
+from ethereum.exceptions import InvalidTransaction, InvalidNonce, \
+    InsufficientBalance, InsufficientStartGas, VerificationFailed
+from ethereum.refcount_db import RefcountDB
+from ethereum.securetrie import SecureTrie
+from ethereum.slogging import get_logger
+from ethereum.transactions import Transaction
+from ethereum.trie import Trie, BLANK_ROOT
+from ethereum.utils import sha3
+
+from pyethapp import sentry
+from pyethapp.metrics import LatencyHistogram
+
+log = get_logger('eth.pipeline')
+
+
+class BlockJob(object):
+
+    "a block travelling through the pipeline"
+
+    def __init__(self, t_block, proto):
+        self.t_block = t_block
+        self.proto = proto
+        self.block = None
+        self.queued_at = time.time()
+        self.started_at = None
+
+    @property
+    def hash(self):
+        return self.t_block.header.hash
+
+
+class Stage(object):
+
+    """
+    Takes jobs from `inqueue`, calls `func(job)` and puts the job into `outqueue`
+    unless `func` returned False. Blocks while `outqueue` is full.
+    """
+
+    def __init__(self, name, func, inqueue, outqueue=None, latency=None):
+        self.name = name
+        self.func = func
+        self.inqueue = inqueue
+        self.outqueue = outqueue
+        self.latency = latency or LatencyHistogram()
+        self.current = None
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill()
+
+    def run(self):
+        while True:
+            job = self.inqueue.peek()  # peek: keep the job visible while processing
+            self.current = job
+            self.inqueue.get()
+            st = time.time()
+            try:
+                passed = self.func(job)
+            except Exception as e:
+                log.error('stage failed', stage=self.name, block=job.t_block, error=e)
+                passed = False
+            self.latency.add(time.time() - st)
+            if passed is not False and self.outqueue is not None:
+                self.outqueue.put(job)  # blocks if the next stage is busy
+            self.current = None
+            gevent.sleep(0)
+
+
+def recover_senders(raw_transactions):
+    senders = []
+    for raw_tx in raw_transactions:
+        try:
+            senders.append(rlp.decode(raw_tx, Transaction).sender)
+        except (rlp.RLPException, InvalidTransaction):
+            senders.append(None)
+    return senders
+
+
+def sender_worker_process(cpipe):
+    "entry point in forked sub processes"
+    gevent.get_hub().SYSTEM_ERROR = BaseException  # stop on any exception
+    while True:
+        cpipe.put(recover_senders(cpipe.get()))
+
+
+class SenderRecoveryPool(object):
+
+    """
+    Recovers transaction senders in `num_workers` sub processes.
+    Communicates with each worker using a list of rlp encoded transactions
+    and expects the list of senders back.
+    """
+
+    chunk_size = 64
+
+    def __init__(self, num_workers):
+        self.idle = Queue()
+        self.processes = []
+        for i in range(num_workers):
+            cpipe, ppipe = gipc.pipe(duplex=True)
+            self.processes.append(gipc.start_process(target=sender_worker_process,
+                                                     args=(cpipe,)))
+            self.idle.put(ppipe)
+
+    def _recover_chunk(self, raw_transactions):
+        ppipe = self.idle.get()
+        try:
+            ppipe.put(raw_transactions)
+            return ppipe.get()
+        finally:
+            self.idle.put(ppipe)
+
+    def recover_raw(self, raw_transactions):
+        "returns the senders of the encoded transactions, None for invalid ones"
+        jobs = [gevent.spawn(self._recover_chunk, raw_transactions[i:i + self.chunk_size])
+                for i in range(0, len(raw_transactions), self.chunk_size)]
+        gevent.joinall(jobs, raise_error=True)
+        return [sender for job in jobs for sender in job.value]
+
+    def recover(self, transactions):
+        "sets the sender of `transactions`, invalid signatures are left to execution"
+        senders = self.recover_raw([rlp.encode(tx) for tx in transactions])
+        for tx, sender in zip(transactions, senders):
+            if sender:
+                tx._sender = sender
+
+    def stop(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+
+
+class CommittedReader(object):
+
+    """
+    Reads the committed data of a db service around its write cache. The
+    cache is shared with the hub, and filling it from a thread could bring
+    back a key deleted meanwhile. Values of a `RefcountDB` are unwrapped.
+    """
+
+    def __init__(self, db):
+        self.refcounted = isinstance(db, RefcountDB)
+        self.backend = db.db if self.refcounted else db
+
+    @classmethod
+    def supports(cls, db):
+        db = db.db if isinstance(db, RefcountDB) else db
+        return hasattr(db, 'get_committed')
+
+    def get(self, key):
+        if self.refcounted:
+            return rlp.decode(self.backend.get_committed(b'r:' + key))[1]
+        return self.backend.get_committed(key)
+
+
+class StatePrefetcher(object):
+
+    """
+    Reads the account leaves, storage roots and contract code a block is going
+    to touch in a thread of the hub's threadpool. Db reads release the GIL, so
+    cold disk reads overlap with the execution of the blocks ahead of it.
+
+    Reads go around the write cache of the db, see `CommittedReader`, and only
+    warm the caches of the db backend and the OS.
+    """
+
+    blank_code_hash = sha3('')
+
+    def __init__(self, db):
+        self.db = CommittedReader(db)
+
+    @staticmethod
+    def addresses(block):
+        addresses = set([block.header.coinbase])
+        for tx in block.transactions:
+            sender = getattr(tx, '_sender', None)  # recovered by the senders stage
+            if sender:
+                addresses.add(sender)
+            if tx.to:
+                addresses.add(tx.to)
+        return addresses
+
+    def warm(self, state_root, addresses):
+        "best effort, a missing node is only a missed prefetch"
+        trie = SecureTrie(Trie(self.db, state_root))
+        for address in addresses:
+            try:
+                rlpdata = trie.get(address)
+                if not rlpdata:
+                    continue
+                _, _, storage_root, code_hash = rlp.decode(rlpdata)
+                if storage_root != BLANK_ROOT:
+                    Trie(self.db, storage_root)  # loads the root node
+                if code_hash != self.blank_code_hash:
+                    self.db.get(code_hash)
+            except Exception as e:
+                log.debug('prefetch failed', error=e)
+
+    def prefetch(self, state_root, block):
+        return gevent.get_hub().threadpool.spawn(self.warm, state_root, self.addresses(block))
+
+
+class BlockPipeline(object):
+
+    """
+    Processes the blocks added to `chainservice` in stages.
+
+    `latency` maps the processing phases to their histograms: the time from
+    receiving a new block to queueing it, the wait in the queue, every stage,
+    the broadcast of new blocks (recorded by the chainservice) and the total
+    time from receiving a new block to having it added.
+    """
+
+    phases = ('receive', 'queue_wait', 'decode', 'check', 'senders', 'prefetch', 'execute',
+              'post', 'broadcast', 'total')
+
+    def __init__(self, chainservice, queue_size=16, sender_workers=0, prefetch=True):
+        self.chainservice = chainservice
+        self.chain = chainservice.chain
+        if prefetch and CommittedReader.supports(self.chain.db):
+            self.prefetcher = StatePrefetcher(self.chain.db)
+        else:
+            self.prefetcher = None  # nothing to read from disk
+        self.queue = Queue(maxsize=chainservice.block_queue_size)
+        self.latency = dict((phase, LatencyHistogram()) for phase in self.phases)
+        if sender_workers:
+            self.sender_pool = SenderRecoveryPool(sender_workers)
+        else:
+            self.sender_pool = None
+
+        stages = [('decode', self.decode), ('check', self.check), ('senders', self.senders),
+                  ('prefetch', self.prefetch), ('execute', self.execute), ('post', self.post)]
+        self.stages = []
+        inqueue = self.queue
+        for i, (name, func) in enumerate(stages):
+            outqueue = Queue(maxsize=queue_size) if i < len(stages) - 1 else None
+            self.stages.append(Stage(name, func, inqueue, outqueue, self.latency[name]))
+            inqueue = outqueue
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        if self.sender_pool:
+            self.sender_pool.stop()
+
+    def put(self, t_block, proto):
+        job = BlockJob(t_block, proto)
+        if t_block.newblock_timestamp:
+            self.latency['receive'].add(job.queued_at - t_block.newblock_timestamp)
+        self.queue.put(job)  # blocks if full
+
+    def jobs(self):
+        for stage in self.stages:
+            for job in stage.inqueue.queue:
+                yield job
+            if stage.current is not None:
+                yield stage.current
+
+    def __contains__(self, block_hash):
+        return any(job.hash == block_hash for job in self.jobs())
+
+    @property
+    def idle(self):
+        return not any(True for _ in self.jobs())
+
+    def stats(self):
+        "latency summary per phase, stages also report their queue length"
+        stats = dict((phase, h.summary()) for phase, h in self.latency.items())
+        for stage in self.stages:
+            stats[stage.name]['queued'] = stage.inqueue.qsize()
+        return stats
+
+    # stages ###########
+
+    def decode(self, job):
+        job.started_at = time.time()
+        self.latency['queue_wait'].add(job.started_at - job.queued_at)
+        t_block = job.t_block
+        if self.chain.has_blockhash(t_block.header.hash):
+            log.warn('known block', block=t_block)
+            return False
+        try:  # deserialize
+            st = time.time()
+            job.block = t_block.to_block()
+            elapsed = time.time() - st
+            log.debug('deserialized', elapsed='%.4fs' % elapsed, ts=time.time(),
+                      gas_used=job.block.gas_used,
+                      gpsec=self.chainservice.gpsec(job.block.gas_used, elapsed))
+        except InvalidTransaction as e:
+            log.warn('invalid transaction', block=t_block, error=e, FIXME='ban node')
+            errtype = \
+                'InvalidNonce' if isinstance(e, InvalidNonce) else \
+                'NotEnoughCash' if isinstance(e, InsufficientBalance) else \
+                'OutOfGasBase' if isinstance(e, InsufficientStartGas) else \
+                'other_transaction_error'
+            sentry.warn_invalid(t_block, errtype)
+            return False
+        except VerificationFailed as e:
+            log.warn('verification failed', error=e, FIXME='ban node')
+            sentry.warn_invalid(t_block, 'other_block_error')
+            return False
+
+    def check(self, job):
+        if job.block.header.hash in self.chainservice.verified_seals:
+            return  # checked in a batch of synced or imported headers
+        if not self.chainservice.check_header(job.block.header):
+            log.warn('header check failed', block=job.t_block, FIXME='ban node')
+            sentry.warn_invalid(job.t_block, 'other_block_error')
+            return False
+
+    def senders(self, job):
+        if self.sender_pool and job.block.transactions:
+            self.sender_pool.recover(job.block.transactions)
+        else:
+            for tx in job.block.transactions:
+                try:
+                    tx.sender  # recovers and caches the sender
+                except InvalidTransaction:
+                    pass  # rejected on execution
+
+    def prefetch(self, job):
+        "doesn't wait for the reads, the blocks ahead are executed meanwhile"
+        if self.prefetcher:
+            self.prefetcher.prefetch(self.chain.state.trie.root_hash, job.block)
+
+    def execute(self, job):
+        block = job.block
+        # the parent may have been ahead in the pipeline, so check this late
+        if self.chain.has_blockhash(block.header.hash):
+            log.warn('known block', block=block)
+            return False
+        if not self.chain.has_blockhash(block.header.prevhash):
+            log.warn('missing parent', block=block, head=self.chain.head)
+            return False
+        log.debug('adding', block=block, ts=time.time())
+        with self.chainservice.add_transaction_lock:
+            added = self.chain.add_block(block)
+        if not added:
+            log.warn('could not add', block=block)
+            self.chainservice.on_block_not_added(block)
+            return False
+        log.info('added', block=block, txs=block.transaction_count, gas_used=block.gas_used)
+
+    def post(self, job):
+        if job.t_block.newblock_timestamp:
+            self.latency['total'].add(time.time() - job.t_block.newblock_timestamp)
+        self.chainservice.on_block_added(job)
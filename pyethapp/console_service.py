@@ -191,6 +191,10 @@ class Console(BaseService):
             def latest(this):
                 return this.chain.head
 
+            @property
+            def protocol_stats(this):
+                return this.chainservice.protocol_stats()
+
             def transact(this, to, value=0, data='', sender=None,
                          startgas=25000, gasprice=60 * denoms.shannon):
                 sender = normalize_address(sender or this.coinbase)
@@ -1,14 +1,37 @@
 from devp2p.protocol import BaseProtocol, SubProtocolError
 from ethereum.transactions import Transaction
 from ethereum.block import Block, BlockHeader
-from ethereum.utils import hash32, int_to_big_endian, big_endian_to_int
+from ethereum.utils import hash32, int_to_big_endian, big_endian_to_int, sha3
 import rlp
-import gevent
 import time
 from ethereum import slogging
+from pyethapp.metrics import ProtocolMetrics
 log = slogging.get_logger('protocol.eth')
 
 
+def rlp_list_items(data, start=0):
+    """
+    Returns the encoded items of the rlp list starting at `start` of `data` as
+    slices of `data`, without decoding them.
+    """
+    typ, length, pos = rlp.codec.consume_length_prefix(data, start)
+    if typ is not list:
+        raise rlp.DecodingError('expected a list', data)
+    end = pos + length
+    items = []
+    while pos < end:
+        _, length, payload = rlp.codec.consume_length_prefix(data, pos)
+        items.append(data[pos:payload + length])
+        pos = payload + length
+    return items
+
+
+def encode_raw_list(items):
+    "rlp encodes a list of already encoded `items`"
+    payload = b''.join(items)
+    return rlp.codec.length_prefix(len(payload), 0xc0) + payload
+
+
 class TransientBlockBody(rlp.Serializable):
     fields = [
         ('transactions', rlp.sedes.CountableList(Transaction)),
@@ -18,7 +41,13 @@ class TransientBlockBody(rlp.Serializable):
 
 class TransientBlock(rlp.Serializable):
 
-    """A partially decoded, unvalidated block."""
+    """
+    A partially decoded, unvalidated block.
+
+    Blocks created by `init_from_raw` keep the encoded transactions and uncles
+    and decode them on first access. Their original encoding is kept as `raw`
+    and reused when the block is relayed.
+    """
 
     fields = [
         ('header', BlockHeader),
@@ -33,11 +62,44 @@ class TransientBlock(rlp.Serializable):
         uncles = rlp.sedes.CountableList(BlockHeader).deserialize(block_data[2])
         return cls(header, transactions, uncles, newblock_timestamp)
 
+    @classmethod
+    def init_from_raw(cls, block_rlp, newblock_timestamp=0):
+        "decodes the header only"
+        items = rlp_list_items(block_rlp)
+        if len(items) != 3:
+            raise rlp.DeserializationError('invalid block', block_rlp)
+        header = rlp.decode(items[0], BlockHeader)
+        block = cls(header, None, None, newblock_timestamp)
+        block.raw = block_rlp
+        block.raw_transactions, block.raw_uncles = items[1:]
+        return block
+
     def __init__(self, header, transactions, uncles, newblock_timestamp=0):
         self.newblock_timestamp = newblock_timestamp
         self.header = header
         self.transactions = transactions
         self.uncles = uncles
+        self.raw = None
+
+    @property
+    def transactions(self):
+        if self._transactions is None:
+            self._transactions = rlp.decode(self.raw_transactions, self.fields[1][1])
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, value):
+        self._transactions = value
+
+    @property
+    def uncles(self):
+        if self._uncles is None:
+            self._uncles = rlp.decode(self.raw_uncles, self.fields[2][1])
+        return self._uncles
+
+    @uncles.setter
+    def uncles(self, value):
+        self._uncles = value
 
     def to_block(self):
         """Convert the transient block to a :class:`ethereum.blocks.Block`"""
@@ -64,18 +126,42 @@ class ETHProtocol(BaseProtocol):
     """
     protocol_id = 1
     network_id = 0
-    max_cmd_id = 15  # FIXME
+    max_cmd_id = 17  # FIXME
     name = 'eth'
-    version = 62
+    version = 63
 
     max_getblocks_count = 128
     max_getblockheaders_count = 192
+    max_getnodedata_count = 384
+    max_getreceipts_count = 256
 
     def __init__(self, peer, service):
         # required by P2PProtocol
         self.config = peer.config
+        self.metrics = ProtocolMetrics(getattr(service, 'protocol_metrics', None))
         BaseProtocol.__init__(self, peer, service)
 
+    def _setup(self):
+        "meters the received messages, see `metrics`"
+        super(ETHProtocol, self)._setup()
+        for name in self.cmd_by_id.values():
+            setattr(self, '_receive_' + name, self._metered_receive(getattr(self, name)))
+
+    def _metered_receive(self, klass):
+        instance = klass()
+        instance.receive_callbacks = getattr(self, 'receive_%s_callbacks' % klass.__name__)
+
+        def receive(packet):
+            st = time.time()
+            data = klass.decode_payload(packet.payload)
+            self.metrics.on_receive(klass.__name__, len(packet.payload), time.time() - st)
+            instance.receive(proto=self, data=data)
+        return receive
+
+    def send_packet(self, packet):
+        self.metrics.on_send(self.cmd_by_id[packet.cmd_id], len(packet.payload))
+        super(ETHProtocol, self).send_packet(packet)
+
     class status(BaseProtocol.command):
 
         """
@@ -136,13 +222,8 @@ class ETHProtocol(BaseProtocol):
 
         @classmethod
         def decode_payload(cls, rlp_data):
-            # convert to dict
-            txs = []
-            for i, tx in enumerate(rlp.decode_lazy(rlp_data)):
-                txs.append(Transaction.deserialize(tx))
-                if not i % 10:
-                    gevent.sleep(0.0001)
-            return txs
+            "returns the encoded transactions, see `ChainService.tx_decoder`"
+            return rlp_list_items(rlp_data)
 
     class getblockheaders(BaseProtocol.command):
 
@@ -194,6 +275,12 @@ class ETHProtocol(BaseProtocol):
         cmd_id = 4
         structure = rlp.sedes.CountableList(BlockHeader)
 
+        @classmethod
+        def encode_payload(cls, headers):
+            "headers may be passed rlp encoded, see `ChainService.header_cache`"
+            return encode_raw_list([h if isinstance(h, bytes) else rlp.encode(h)
+                                    for h in headers])
+
     class getblockbodies(BaseProtocol.command):
 
         """
@@ -224,6 +311,12 @@ class ETHProtocol(BaseProtocol):
                 bodies = [TransientBlockBody(b.transactions, b.uncles) for b in bodies]
             return bodies
 
+        @classmethod
+        def encode_payload(cls, bodies):
+            "bodies may be passed rlp encoded, see `ChainService.body_cache`"
+            return encode_raw_list([b if isinstance(b, bytes) else rlp.encode(b)
+                                    for b in bodies])
+
     class newblock(BaseProtocol.command):
 
         """
@@ -241,9 +334,106 @@ class ETHProtocol(BaseProtocol):
         def decode_payload(cls, rlp_data):
             # convert to dict
             # print rlp_data.encode('hex')
-            ll = rlp.decode_lazy(rlp_data)
-            assert len(ll) == 2
-            transient_block = TransientBlock.init_from_rlp(ll[0], time.time())
-            difficulty = rlp.sedes.big_endian_int.deserialize(ll[1])
+            items = rlp_list_items(rlp_data)
+            assert len(items) == 2
+            transient_block = TransientBlock.init_from_raw(items[0], time.time())
+            difficulty = rlp.decode(items[1], rlp.sedes.big_endian_int)
             data = [transient_block, difficulty]
             return dict((cls.structure[i][0], v) for i, v in enumerate(data))
+
+        @classmethod
+        def encode_payload(cls, data):
+            "relays received blocks in their original encoding"
+            if isinstance(data, dict):
+                data = [data[x[0]] for x in cls.structure]
+            block, chain_difficulty = data
+            if getattr(block, 'raw', None) is None:
+                return super(ETHProtocol.newblock, cls).encode_payload(data)
+            return encode_raw_list([block.raw, rlp.encode(chain_difficulty,
+                                                          rlp.sedes.big_endian_int)])
+
+    class getnodedata(BaseProtocol.command):
+
+        """
+        [+0x0d, hash_0: B_32, hash_1: B_32, ...]
+        Require peer to return a NodeData message. Hint that useful values in it
+        are those which correspond to given hashes.
+        """
+        cmd_id = 13
+        structure = rlp.sedes.CountableList(rlp.sedes.binary)
+
+    class nodedata(BaseProtocol.command):
+
+        """
+        [+0x0e, value_0: B, value_1: B, ...]
+        Provide a set of values which correspond to previously asked node data
+        hashes from GetNodeData.
+        """
+        cmd_id = 14
+        structure = rlp.sedes.CountableList(rlp.sedes.binary)
+
+    class getreceipts(BaseProtocol.command):
+
+        """
+        [+0x0f, hash_0: B_32, hash_1: B_32, ...]
+        Require peer to return a Receipts message. Hint that useful values in it
+        are those which correspond to blocks of the given hashes.
+        """
+        cmd_id = 15
+        structure = rlp.sedes.CountableList(rlp.sedes.binary)
+
+    class receipts(BaseProtocol.command):
+
+        """
+        [+0x10, [receipt_0, receipt_1], ...]
+        Provide a set of receipts which correspond to previously asked in GetReceipts.
+        """
+        cmd_id = 16
+        structure = rlp.sedes.CountableList(rlp.sedes.raw)
+
+        @classmethod
+        def encode_payload(cls, receipts):
+            "takes the encoded receipts of each block, see `ChainService.receipts`"
+            return encode_raw_list(receipts)
+
+        @classmethod
+        def decode_payload(cls, rlp_data):
+            return rlp_list_items(rlp_data)
+
+    class compactblock(BaseProtocol.command):
+
+        """
+        [+0x11, blockHeader, [shortTxId_0, shortTxId_1, ...], uncleList, totalDifficulty]
+        pyethapp extension, sent instead of NewBlock to peers which share the
+        `CompactBlocksProtocol` capability (`eth.block_relay.compact`).
+        Transactions are identified by the first `short_id_length` bytes of their hash,
+        the receiver rebuilds the block from its transaction pool.
+        """
+        cmd_id = 17
+        short_id_length = 8
+
+        structure = [
+            ('header', BlockHeader),
+            ('short_ids', rlp.sedes.CountableList(rlp.sedes.binary)),
+            ('uncles', rlp.sedes.CountableList(BlockHeader)),
+            ('chain_difficulty', rlp.sedes.big_endian_int)]
+
+        def create(self, proto, block, chain_difficulty):
+            if getattr(block, 'raw', None) is not None:  # hash without decoding
+                tx_hashes = [sha3(tx) for tx in rlp_list_items(block.raw_transactions)]
+            else:
+                tx_hashes = [tx.hash for tx in block.transactions]
+            short_ids = [h[:self.short_id_length] for h in tx_hashes]
+            return [block.header, short_ids, block.uncles, chain_difficulty]
+
+
+class CompactBlocksProtocol(BaseProtocol):
+
+    """
+    pyethapp capability without commands of its own. Peers which both announce
+    it accept `ETHProtocol.compactblock`, other clients don't see it.
+    """
+    protocol_id = 2
+    name = 'pcb'
+    version = 1
+    max_cmd_id = 0
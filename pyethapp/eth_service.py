@@ -1,36 +1,43 @@
 # -*- coding: utf8 -*-
+import math
+import os
+import random
 import time
-from collections import deque
+from collections import OrderedDict
 
 import eth_protocol
 import gevent
 import gevent.lock
 from gevent.event import AsyncResult
 import rlp
-import statistics
 from devp2p.protocol import BaseProtocol
 from devp2p.service import WiredService
 from ethereum.block import Block
 from ethereum.chain import Chain
 from ethereum.config import Env
 from ethereum import config as ethereum_config
-from ethereum.state import get_block
 from ethereum.state_transition import check_block_header, validate_transaction, apply_transaction
 from ethereum.casper_utils import casper_config
-from ethereum.transaction_queue import TransactionQueue
+from ethereum.trie import Trie
+from ethereum.db import EphemDB
 from ethereum.refcount_db import RefcountDB
 from ethereum.slogging import get_logger
-from ethereum.exceptions import InvalidTransaction, InvalidNonce, \
-    InsufficientBalance, InsufficientStartGas, VerificationFailed
+from ethereum.exceptions import InvalidTransaction
 from ethereum.transactions import Transaction
 from ethereum.casper_utils import get_casper_ct, casper_contract_bootstrap, casper_start_epoch, validator_inject, generate_validation_code, RandaoManager, call_casper
-from ethereum.utils import privtoaddr, encode_hex, decode_hex, remove_0x_head, normalize_address
-from gevent.queue import Queue
+from ethereum.utils import privtoaddr, encode_hex, decode_hex, remove_0x_head, normalize_address, \
+    sha3
 from rlp.utils import encode_hex
 from synchronizer import Synchronizer
 
-from pyethapp import sentry
+from pyethapp.block_cache import HeaderCache, BodyCache
+from pyethapp.block_pipeline import BlockPipeline
 from pyethapp.dao import is_dao_challenge, build_dao_header
+from pyethapp.ethash_batch import check_pow_batch
+from pyethapp.metrics import ProtocolMetrics
+from pyethapp.receipts import ReceiptsStore
+from pyethapp.state_cache import PostStateCache, GasEstimator
+from pyethapp.tx_pool import TransactionPool, TransactionJournal
 
 log = get_logger('eth.chainservice')
 
@@ -39,23 +46,31 @@ class DuplicatesFilter(object):
 
     def __init__(self, max_items=128):
         self.max_items = max_items
-        self.filter = list()
+        self.filter = OrderedDict()
 
     def update(self, data):
         "returns True if unknown"
         if data not in self.filter:
-            self.filter.append(data)
+            self.filter[data] = True
             if len(self.filter) > self.max_items:
-                self.filter.pop(0)
+                self.filter.popitem(last=False)
             return True
         else:
-            self.filter.append(self.filter.pop(0))
+            k, v = self.filter.popitem(last=False)
+            self.filter[k] = v
             return False
 
     def __contains__(self, v):
         return v in self.filter
 
 
+def tx_list_root(transactions):
+    trie = Trie(EphemDB())
+    for i, tx in enumerate(transactions):
+        trie.update(rlp.encode(i), rlp.encode(tx))
+    return trie.root_hash
+
+
 def update_watcher(chainservice):
     timeout = 180
     d = dict(head=chainservice.chain.head)
@@ -103,6 +118,231 @@ class DAOChallenger(object):
         self.deferred.set(blockheaders)
 
 
+class TransactionDecoder(object):
+
+    """
+    Decodes the transactions received from peers.
+
+    Transactions are dropped by the hash of their encoding if `is_known(hash)`,
+    before anything is decoded. Decoding yields to other greenlets every
+    `max_blocking` seconds. For messages of at least `pool_threshold`
+    transactions the senders are recovered meanwhile by `sender_pool`.
+    """
+
+    def __init__(self, is_known, sender_pool=None, pool_threshold=64, max_blocking=0.01):
+        self.is_known = is_known
+        self.sender_pool = sender_pool
+        self.pool_threshold = pool_threshold
+        self.max_blocking = max_blocking
+
+    def unknown(self, raw_transactions, hashes=None):
+        "returns the raw transactions not known yet, without duplicates"
+        hashes = hashes or [sha3(raw_tx) for raw_tx in raw_transactions]
+        seen = set()
+        fresh = []
+        for raw_tx, tx_hash in zip(raw_transactions, hashes):
+            if tx_hash not in seen and not self.is_known(tx_hash):
+                seen.add(tx_hash)
+                fresh.append(raw_tx)
+        return fresh
+
+    def decode_tx(self, raw_tx):
+        "returns None if `raw_tx` is not a valid transaction encoding"
+        try:
+            return rlp.decode(raw_tx, Transaction)
+        except (rlp.RLPException, InvalidTransaction) as e:
+            log.debug('undecodable tx', error=e)
+
+    def decode(self, raw_transactions, hashes=None):
+        fresh = self.unknown(raw_transactions, hashes)
+        recovery = None
+        if self.sender_pool and len(fresh) >= self.pool_threshold:
+            recovery = gevent.spawn(self.sender_pool.recover_raw, fresh)
+        transactions = []
+        st = time.time()
+        for raw_tx in fresh:
+            transactions.append(self.decode_tx(raw_tx))
+            if time.time() - st > self.max_blocking:
+                gevent.sleep(0)
+                st = time.time()
+        if recovery:
+            for tx, sender in zip(transactions, recovery.get()):
+                if tx and sender:
+                    tx._sender = sender
+        return [tx for tx in transactions if tx]
+
+
+class NonceGapState(object):
+
+    """
+    The head state as `validate_transaction` sees it for `tx`: nonces and
+    balances are read from the cache of `validator`, a nonce up to
+    `max_nonce_gap` ahead of the account is the expected one, and no gas is
+    used yet. Everything else is read from the head state.
+    """
+
+    gas_used = 0
+
+    def __init__(self, validator, tx):
+        self.validator = validator
+        self.tx = tx
+
+    def get_nonce(self, address):
+        nonce = self.validator.account(address)[0]
+        if nonce <= self.tx.nonce <= nonce + self.validator.max_nonce_gap:
+            return self.tx.nonce
+        return nonce
+
+    def get_balance(self, address):
+        return self.validator.account(address)[1]
+
+    def __getattr__(self, name):
+        return getattr(self.validator.chain.state, name)
+
+
+class TransactionValidator(object):
+
+    """
+    Validates transactions against the head state. The nonce and balance of
+    senders are read once per head and cached until `reset`, so floods of
+    transactions don't read the state trie for each one.
+
+    Unlike `validate_transaction` nonces up to `max_nonce_gap` ahead of the
+    account are accepted, the pool queues them. Peers are allowed
+    `max_rejects_per_peer` rejected transactions per head, further transactions
+    of theirs are dropped unchecked until the next head.
+    """
+
+    def __init__(self, chain, max_nonce_gap=64, max_rejects_per_peer=256):
+        self.chain = chain
+        self.max_nonce_gap = max_nonce_gap
+        self.max_rejects_per_peer = max_rejects_per_peer
+        self.accounts = dict()  # address: (nonce, balance)
+        self.next_nonces = dict()  # address: nonce after the continuous txs seen
+        self.rejects = dict()  # origin: count
+
+    def reset(self, block=None):
+        self.accounts.clear()
+        self.next_nonces.clear()
+        self.rejects.clear()
+
+    def account(self, address):
+        if address not in self.accounts:
+            state = self.chain.state
+            self.accounts[address] = (state.get_nonce(address), state.get_balance(address))
+        return self.accounts[address]
+
+    def validate(self, tx):
+        "raises InvalidTransaction"
+        validate_transaction(NonceGapState(self, tx), tx)
+
+    def validate_batch(self, transactions, origin=None):
+        "returns the valid transactions"
+        valid = []
+        for tx in transactions:
+            if self.rejects.get(origin, 0) >= self.max_rejects_per_peer:
+                log.debug('too many rejected txs, dropping', remote_id=origin,
+                          dropped=len(transactions) - len(valid))
+                break
+            try:
+                self.validate(tx)
+                valid.append(tx)
+            except InvalidTransaction as e:
+                log.debug('invalid tx', error=e)
+                if origin is not None:
+                    self.rejects[origin] = self.rejects.get(origin, 0) + 1
+        return valid
+
+    def continues_nonce(self, tx):
+        """
+        if the valid tx continues the account nonce of its sender, directly or
+        after the sender's transactions seen since the last head. Only those are
+        broadcast, the ones behind a nonce gap are just pooled.
+        """
+        nonce = self.next_nonces.get(tx.sender)
+        if nonce is None:
+            nonce = self.account(tx.sender)[0]
+        if tx.nonce > nonce:
+            return False
+        self.next_nonces[tx.sender] = max(nonce, tx.nonce + 1)
+        return True
+
+
+class TransactionBatcher(object):
+
+    """
+    Collects the transactions to be sent to a single peer and sends them in
+    batched `transactions` messages.
+
+    A batch is sent `window` seconds after its first transaction was added or as
+    soon as it holds `max_batch` transactions. Transactions the peer is known to
+    have are skipped and the outbound tx traffic is capped at `max_bytes_per_sec`.
+    """
+
+    def __init__(self, proto, window=0.1, max_batch=256, max_bytes_per_sec=256 * 1024,
+                 max_pending=4096, known_size=4096):
+        self.proto = proto
+        self.window = window
+        self.max_batch = max_batch
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_pending = max_pending
+        self.known = DuplicatesFilter(max_items=known_size)
+        self.pending = []
+        self.allowance = max_bytes_per_sec
+        self.last_refill = time.time()
+        self.flusher = None
+        self.flushing = False
+
+    def mark_known(self, tx_hash):
+        "the peer sent us this tx, never send it back"
+        self.known.update(tx_hash)
+
+    def add(self, tx):
+        "returns True if the tx was queued for sending"
+        if not self.known.update(tx.hash):
+            return False
+        if len(self.pending) >= self.max_pending:
+            log.debug('tx batch overflow, dropping tx', proto=self.proto)
+            return False
+        self.pending.append(tx)
+        if self.flusher is None:
+            self.flusher = gevent.spawn_later(self.window, self.flush)
+        elif len(self.pending) >= self.max_batch and not self.flushing:
+            # window not over yet, but batch is full
+            self.flusher.kill(block=False)
+            self.flusher = gevent.spawn(self.flush)
+        return True
+
+    def flush(self):
+        self.flushing = True
+        try:
+            while self.pending and not self.proto.is_stopped:
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                self.throttle(sum(len(rlp.encode(tx)) for tx in batch))
+                log.debug('sending tx batch', num=len(batch), proto=self.proto)
+                self.proto.send_transactions(*batch)
+        finally:
+            self.flushing = False
+            self.flusher = None
+
+    def throttle(self, num_bytes):
+        "token bucket, sleeps until `num_bytes` may be sent"
+        now = time.time()
+        self.allowance = min(self.max_bytes_per_sec, self.allowance +
+                             (now - self.last_refill) * self.max_bytes_per_sec)
+        self.last_refill = now
+        self.allowance -= num_bytes
+        if self.allowance < 0:
+            gevent.sleep(-self.allowance / float(self.max_bytes_per_sec))
+
+    def stop(self):
+        if self.flusher:
+            self.flusher.kill(block=False)
+        self.flusher = None
+        self.pending = []
+
+
 class ChainService(WiredService):
 
     """
@@ -111,7 +351,14 @@ class ChainService(WiredService):
     # required by BaseService
     name = 'chain'
     default_config = dict(
-        eth=dict(network_id=0, genesis='', pruning=-1),
+        eth=dict(network_id=0, genesis='', pruning=-1,
+                 tx_broadcast=dict(window=0.1, max_batch=256, max_bytes_per_sec=256 * 1024),
+                 tx_pool=dict(capacity=4096, price_bump=10),
+                 tx_validation=dict(max_nonce_gap=64, max_rejects_per_peer=256),
+                 tx_journal=dict(path='transactions.rlp', interval=60),
+                 header_cache_size=2048, body_cache_size=256,
+                 block_relay=dict(compact=False),  # see CompactBlocksService
+                 block_pipeline=dict(queue_size=16, sender_workers=0, prefetch=True)),
         block=ethereum_config.default_config
     )
 
@@ -124,9 +371,9 @@ class ChainService(WiredService):
     synchronizer = None
     config = None
     block_queue_size = 1024
-    transaction_queue_size = 1024
     processed_gas = 0
     processed_elapsed = 0
+    pow_strategies = ('pow', 'ethpow', 'ethash', 'ethereum1')  # blocks with ethash seals
 
     def __init__(self, app):
         self.config = app.config
@@ -184,15 +431,69 @@ class ChainService(WiredService):
         self.dao_challenges = dict()
         self.synchronizer = Synchronizer(self, force_sync=None)
 
-        self.block_queue = Queue(maxsize=self.block_queue_size)
-        #self.transaction_queue = Queue(maxsize=self.transaction_queue_size)
-        self.transaction_queue = TransactionQueue()
+        self.block_pipeline = BlockPipeline(self, **sce['block_pipeline'])
+        self.block_queue = self.block_pipeline.queue
+        self.transaction_queue = TransactionPool(
+            lambda address: self.chain.state.get_nonce(address), **sce['tx_pool'])
         self.min_gasprice = 20 * 10**9 # TODO: better be an option to validator service?
-        self.add_blocks_lock = False
         self.add_transaction_lock = gevent.lock.Semaphore()
-        self.broadcast_filter = DuplicatesFilter()
+        self.broadcast_filter = DuplicatesFilter(max_items=4096)
+        self.verified_seals = DuplicatesFilter(max_items=4096)  # header hashes, see check_seals
+        self.tx_decoder = TransactionDecoder(lambda tx_hash: tx_hash in self.broadcast_filter,
+                                             self.block_pipeline.sender_pool)
+        self.tx_batchers = dict()  # proto: TransactionBatcher
+        self.compact_block_stats = dict(rebuilt=0, fetched=0)  # received compactblocks
+        self.tx_validator = TransactionValidator(self.chain, **sce['tx_validation'])
+        self.protocol_metrics = ProtocolMetrics()  # totals of all peers
         self.on_new_head_cbs = []
-        self.newblock_processing_times = deque(maxlen=1000)
+        self.on_new_transaction_cbs = []  # called with txs added to the pool
+        self.on_block_queued_cbs = []  # called with blocks the chain may have queued
+        self.header_cache = HeaderCache(self.chain, sce['header_cache_size'])
+        self.on_new_head_cbs.append(self.header_cache.on_new_head)
+        self.body_cache = BodyCache(self.chain, sce['body_cache_size'])
+        self.receipts = ReceiptsStore(self.chain)
+        self.post_states = PostStateCache(self.chain)  # for calls
+        self.gas_estimator = GasEstimator()
+        self.on_new_head_cbs.append(self.receipts.on_new_head)
+        self.tx_journal = None
+        if sce['tx_journal']['path'] and 'data_dir' in self.config:
+            path = os.path.join(self.config['data_dir'], sce['tx_journal']['path'])
+            self.tx_journal = TransactionJournal(path)
+            self.replay_tx_journal()
+        self.tx_pool_loop = gevent.spawn(self._tx_pool_loop, sce['tx_journal']['interval'])
+        self.block_pipeline.start()
+
+    def stop(self):
+        self.block_pipeline.stop()
+        self.tx_pool_loop.kill(block=False)
+        if self.tx_journal:
+            self.tx_journal.close()
+        super(ChainService, self).stop()
+
+    def replay_tx_journal(self):
+        "adds the journaled local transactions still valid to the pool"
+        txs = self.tx_journal.load()
+        for tx in txs:
+            try:
+                self.tx_validator.validate(tx)
+            except InvalidTransaction:
+                continue
+            self.transaction_queue.add_transaction(tx, local=True)
+        log.info('replayed tx journal', records=len(txs), pooled=len(self.transaction_queue))
+        self.tx_journal.compact(self.transaction_queue, force=True)
+
+    def rebroadcast_local_transactions(self):
+        "sends the pooled local transactions to the peers not known to have them"
+        for tx in self.transaction_queue.local_transactions():
+            for batcher in self.tx_batchers.values():
+                batcher.add(tx)
+
+    def _tx_pool_loop(self, interval):
+        while True:
+            gevent.sleep(interval)
+            self.rebroadcast_local_transactions()
+            if self.tx_journal:
+                self.tx_journal.compact(self.transaction_queue)
 
     @property
     def is_syncing(self):
@@ -207,11 +508,13 @@ class ChainService(WiredService):
         return False
 
     def _on_new_head(self, block):
+        self.tx_validator.reset()
         log.debug('new head cbs', num=len(self.on_new_head_cbs))
         for cb in self.on_new_head_cbs:
             cb(block)
 
-    def add_transaction(self, tx, origin=None, force_broadcast=False, force=False):
+    def add_transaction(self, tx, origin=None, force_broadcast=False, force=False,
+                        validated=False):
         if self.is_syncing:
             if force_broadcast:
                 assert origin is None  # only allowed for local txs
@@ -226,17 +529,12 @@ class ChainService(WiredService):
             log.debug('discarding known tx')  # discard early
             return
 
-        # validate transaction
-        try:
-            # Transaction validation for broadcasting. Transaction is validated
-            # against the (same) head state each time. Conflicting transaction
-            # may pass the check.
-            validate_transaction(self.chain.state, tx)
-            log.debug('valid tx, broadcasting')
-            self.broadcast_transaction(tx, origin=origin)  # asap
-        except InvalidTransaction as e:
-            log.debug('invalid tx', error=e)
+        # Transaction validation for broadcasting. Transaction is validated
+        # against the (same) head state each time. Conflicting transaction
+        # may pass the check.
+        if not validated and not self.tx_validator.validate_batch([tx], origin):
             return
+        self._relay_transaction(tx, origin)
 
         if origin is not None:  # not locally added via jsonrpc
             if not self.is_mining or self.is_syncing:
@@ -244,22 +542,48 @@ class ChainService(WiredService):
                 return
 
         if tx.gasprice >= self.min_gasprice:
-            self.add_transaction_lock.acquire()
-            self.transaction_queue.add_transaction(tx, force=force)
-            self.add_transaction_lock.release()
+            self._pool_transaction(tx, origin, force)
         else:
             log.info("too low gasprice, ignore", tx=encode_hex(tx.hash)[:8], gasprice=tx.gasprice)
         return len(self.transaction_queue)
 
+    def _relay_transaction(self, tx, origin):
+        # txs behind a nonce gap are pooled but not relayed, peers could
+        # otherwise flood the network with txs that may never be mined
+        if self.tx_validator.continues_nonce(tx) or origin is None:
+            log.debug('valid tx, broadcasting')
+            self.broadcast_transaction(tx, origin=origin)  # asap
+
+    def _pool_transaction(self, tx, origin, force):
+        self.add_transaction_lock.acquire()
+        added = self.transaction_queue.add_transaction(tx, force=force, local=origin is None)
+        self.add_transaction_lock.release()
+        if added:
+            if self.tx_journal and origin is None:  # only local txs are journaled
+                self.tx_journal.append(tx)
+            for cb in self.on_new_transaction_cbs:
+                cb(tx)
+
     def check_header(self, header, **kwargs):
         return check_block_header(self.chain.state, header, **kwargs)
 
+    def check_seals(self, headers):
+        """
+        returns for each header if its PoW seal is valid, checked in batches,
+        headers of chains with another consensus strategy have no PoW seal
+        """
+        if self.chain.env.config['CONSENSUS_STRATEGY'] not in self.pow_strategies:
+            return [True] * len(headers)
+        valid_seals = check_pow_batch(headers)
+        for header, valid in zip(headers, valid_seals):
+            if valid:  # the block pipeline doesn't check these again
+                self.verified_seals.update(header.hash)
+        return [valid or header.number == 0  # genesis has no seal
+                for header, valid in zip(headers, valid_seals)]
+
     def add_block(self, t_block, proto):
-        "adds a block to the block_queue and spawns _add_block if not running"
-        self.block_queue.put((t_block, proto))  # blocks if full
-        if not self.add_blocks_lock:
-            self.add_blocks_lock = True  # need to lock here (ctx switch is later)
-            gevent.spawn(self._add_blocks)
+        "adds a block to the block pipeline"
+        self.block_pipeline.put(t_block, proto)  # blocks if full
 
     def add_mined_block(self, block):
         log.debug('adding mined block', block=block)
@@ -267,7 +591,7 @@ class ChainService(WiredService):
         if self.chain.add_block(block):
             log.debug('added', block=block, ts=time.time())
             assert block == self.chain.head
-            self.transaction_queue = self.transaction_queue.diff(block.transactions)
+            self.transaction_queue.remove(block.transactions)
             self.broadcast_newblock(block, chain_difficulty=block.chain_difficulty())
             return True
         return False
@@ -277,76 +601,33 @@ class ChainService(WiredService):
         if self.chain.has_blockhash(block_hash):
             return True
         # check if queued or processed
-        for i in range(len(self.block_queue.queue)):
-            if block_hash == self.block_queue.queue[i][0].header.hash:
-                return True
-        return False
+        return block_hash in self.block_pipeline
 
-    def _add_blocks(self):
-        log.debug('add_blocks', qsize=self.block_queue.qsize(),
-                  add_tx_lock=self.add_transaction_lock.locked())
-        assert self.add_blocks_lock is True
-        self.add_transaction_lock.acquire()
-        try:
-            while not self.block_queue.empty():
-                # sleep at the beginning because continue keywords will skip bottom
-                gevent.sleep(0.001)
-
-                t_block, proto = self.block_queue.peek()  # peek: knows_block while processing
-                if self.chain.has_blockhash(t_block.header.hash):
-                    log.warn('known block', block=t_block)
-                    self.block_queue.get()
-                    continue
-                if not self.chain.has_blockhash(t_block.header.prevhash):
-                    log.warn('missing parent', block=t_block, head=self.chain.head)
-                    self.block_queue.get()
-                    continue
-                try:  # deserialize
-                    st = time.time()
-                    block = t_block.to_block()
-                    elapsed = time.time() - st
-                    log.debug('deserialized', elapsed='%.4fs' % elapsed, ts=time.time(),
-                              gas_used=block.gas_used, gpsec=self.gpsec(block.gas_used, elapsed))
-                except InvalidTransaction as e:
-                    log.warn('invalid transaction', block=t_block, error=e, FIXME='ban node')
-                    errtype = \
-                        'InvalidNonce' if isinstance(e, InvalidNonce) else \
-                        'NotEnoughCash' if isinstance(e, InsufficientBalance) else \
-                        'OutOfGasBase' if isinstance(e, InsufficientStartGas) else \
-                        'other_transaction_error'
-                    sentry.warn_invalid(t_block, errtype)
-                    self.block_queue.get()
-                    continue
-                except VerificationFailed as e:
-                    log.warn('verification failed', error=e, FIXME='ban node')
-                    sentry.warn_invalid(t_block, 'other_block_error')
-                    self.block_queue.get()
-                    continue
-
-                # All checks passed
-                log.debug('adding', block=block, ts=time.time())
-                if self.chain.add_block(block):
-                    now = time.time()
-                    log.info('added', block=block, txs=block.transaction_count,
-                             gas_used=block.gas_used)
-                    if t_block.newblock_timestamp:
-                        total = now - t_block.newblock_timestamp
-                        self.newblock_processing_times.append(total)
-                        avg = statistics.mean(self.newblock_processing_times)
-                        med = statistics.median(self.newblock_processing_times)
-                        max_ = max(self.newblock_processing_times)
-                        min_ = min(self.newblock_processing_times)
-                        log.info('processing time', last=total, avg=avg, max=max_, min=min_,
-                                 median=med)
-                    if self.is_mining:
-                        self.transaction_queue = self.transaction_queue.diff(block.transactions)
-                else:
-                    log.warn('could not add', block=block)
+    def on_block_not_added(self, block):
+        "the chain queues blocks received before their timestamp or parent"
+        for cb in self.on_block_queued_cbs:
+            cb(block)
 
-                self.block_queue.get()  # remove block from queue (we peeked only)
-        finally:
-            self.add_blocks_lock = False
-            self.add_transaction_lock.release()
+    def on_block_added(self, job):
+        "post-processing of blocks added by the block pipeline"
+        block, t_block = job.block, job.t_block
+        if t_block.newblock_timestamp:
+            latency = self.block_pipeline.latency['total']  # percentiles via debug_ rpc
+            log.info('processing time', last=time.time() - t_block.newblock_timestamp,
+                     avg=latency.mean, max=latency.max, min=latency.min)
+        self.transaction_queue.remove(block.transactions)
+
+    def protocol_stats(self):
+        "eth protocol traffic per command and request latency, in total and per peer"
+        peers = []
+        for peer in self.app.services.peermanager.peers:
+            if self.wire_protocol in peer.protocols:
+                stats = peer.protocols[self.wire_protocol].metrics.summary()
+                stats.update(remote_id=encode_hex(peer.remote_pubkey),
+                             client_version=peer.remote_client_version)
+                peers.append(stats)
+        return dict(total=self.protocol_metrics.summary(), peers=peers,
+                    compact_blocks=dict(self.compact_block_stats))
 
     def gpsec(self, gas_spent=0, elapsed=0):
         if gas_spent:
@@ -355,25 +636,46 @@ class ChainService(WiredService):
         return int(self.processed_gas / (0.001 + self.processed_elapsed))
 
     def broadcast_newblock(self, block, chain_difficulty=None, origin=None):
+        """
+        Pushes the block to about the square root of the number of peers and
+        announces its hash to all of them, so the others, and push targets which
+        drop the block, fetch it if they still need it.
+        """
         if not chain_difficulty:
             assert self.chain.has_blockhash(block.hash)
             chain_difficulty = block.chain_difficulty()
         assert isinstance(block, (eth_protocol.TransientBlock, Block))
         if self.broadcast_filter.update(block.header.hash):
             log.debug('broadcasting newblock', origin=origin)
-            bcast = self.app.services.peermanager.broadcast
-            bcast(eth_protocol.ETHProtocol, 'newblock', args=(block, chain_difficulty),
-                  exclude_peers=[origin.peer] if origin else [])
+            st = time.time()
+            protos = [p.protocols[self.wire_protocol] for p in self.app.services.peermanager.peers
+                      if self.wire_protocol in p.protocols and not (origin and p == origin.peer)]
+            random.shuffle(protos)
+            num_push = int(math.ceil(math.sqrt(len(protos))))
+            announcement = self.wire_protocol.newblockhashes.Data(block.header.hash,
+                                                                  block.header.number)
+            for proto in protos[:num_push]:
+                if self.compact_blocks_enabled(proto):
+                    proto.send_compactblock(block, chain_difficulty)
+                else:
+                    proto.send_newblock(block, chain_difficulty)
+            for proto in protos:
+                proto.send_newblockhashes(announcement)
+            self.block_pipeline.latency['broadcast'].add(time.time() - st)
         else:
             log.debug('already broadcasted block')
 
+    def compact_blocks_enabled(self, proto):
+        "if both sides announced the compact blocks capability, see `CompactBlocksService`"
+        return eth_protocol.CompactBlocksProtocol in proto.peer.protocols
+
     def broadcast_transaction(self, tx, origin=None):
         assert isinstance(tx, Transaction)
         if self.broadcast_filter.update(tx.hash):
             log.debug('broadcasting tx', origin=origin)
-            bcast = self.app.services.peermanager.broadcast
-            bcast(eth_protocol.ETHProtocol, 'transactions', args=(tx,),
-                  exclude_peers=[origin.peer] if origin else [])
+            for proto, batcher in self.tx_batchers.items():
+                if proto != origin:
+                    batcher.add(tx)
         else:
             log.debug('already broadcasted tx')
 
@@ -392,6 +694,11 @@ class ChainService(WiredService):
         proto.receive_getblockbodies_callbacks.append(self.on_receive_getblockbodies)
         proto.receive_blockbodies_callbacks.append(self.on_receive_blockbodies)
         proto.receive_newblock_callbacks.append(self.on_receive_newblock)
+        proto.receive_compactblock_callbacks.append(self.on_receive_compactblock)
+        proto.receive_getnodedata_callbacks.append(self.on_receive_getnodedata)
+        proto.receive_getreceipts_callbacks.append(self.on_receive_getreceipts)
+
+        self.tx_batchers[proto] = TransactionBatcher(proto, **self.config['eth']['tx_broadcast'])
 
         # send status
         head = self.chain.head
@@ -402,6 +709,9 @@ class ChainService(WiredService):
         assert isinstance(proto, self.wire_protocol)
         log.debug('----------------------------------')
         log.debug('on_wire_protocol_stop', proto=proto)
+        batcher = self.tx_batchers.pop(proto, None)
+        if batcher:
+            batcher.stop()
 
     def on_receive_status(self, proto, eth_version, network_id, chain_difficulty, chain_head_hash,
                           genesis_hash):
@@ -430,9 +740,10 @@ class ChainService(WiredService):
             self.synchronizer.receive_status(proto, chain_head_hash, chain_difficulty)
             # send transactions
             transactions = self.transaction_queue.peek()
-            if transactions:
+            if transactions and proto in self.tx_batchers:
                 log.debug("sending transactions", remote_id=proto)
-                proto.send_transactions(*transactions)
+                for item in transactions:
+                    self.tx_batchers[proto].add(item.tx)
         else:
             log.debug("peer failed to answer DAO challenge, stop.", proto=proto)
             if proto.peer:
@@ -442,11 +753,19 @@ class ChainService(WiredService):
     # transactions
 
     def on_receive_transactions(self, proto, transactions):
-        "receives rlp.decoded serialized"
+        "receives the encoded transactions"
         log.debug('----------------------------------')
         log.debug('remote_transactions_received', count=len(transactions), remote_id=proto)
-        for tx in transactions:
-            self.add_transaction(tx, origin=proto)
+        hashes = [sha3(raw_tx) for raw_tx in transactions]
+        batcher = self.tx_batchers.get(proto)
+        if batcher:
+            for tx_hash in hashes:
+                batcher.mark_known(tx_hash)
+        if self.is_syncing:
+            return  # we can not evaluate the txs based on outdated state
+        transactions = self.tx_decoder.decode(transactions, hashes)
+        for tx in self.tx_validator.validate_batch(transactions, proto):
+            self.add_transaction(tx, origin=proto, validated=True)
 
     # blockhashes ###########
 
@@ -466,75 +785,22 @@ class ChainService(WiredService):
         log.debug('----------------------------------')
         log.debug("handle_getblockheaders", amount=amount, block=block_id)
 
-        headers = []
         max_hashes = min(amount, self.wire_protocol.max_getblockheaders_count)
 
         if hash_mode:
-            origin_hash = hash_or_number[0]
+            origin = self.header_cache.number_of(hash_or_number[0])
         else:
             if is_dao_challenge(self.config['eth']['block'], hash_or_number[1], amount, skip):
                 log.debug("sending: answer DAO challenge")
-                headers.append(build_dao_header(self.config['eth']['block']))
-                proto.send_blockheaders(*headers)
+                proto.send_blockheaders(build_dao_header(self.config['eth']['block']))
                 return
-            try:
-                origin_hash = self.chain.get_blockhash_by_number(hash_or_number[1])
-            except KeyError:
-                origin_hash = b''
-        if not origin_hash or self.chain.has_blockhash(origin_hash):
+            origin = hash_or_number[1]
+        if origin is None:
             log.debug("unknown block")
             proto.send_blockheaders(*[])
             return
 
-        unknown = False
-        while not unknown and (headers) < max_hashes:
-            if not origin_hash:
-                break
-            try:
-                block_rlp = self.chain.db.get(last)
-                if block_rlp == 'GENESIS':
-                    #last = self.chain.genesis.header.prevhash
-                    break
-                else:
-                    last = rlp.decode_lazy(block_rlp)[0][0]  # [head][prevhash]
-            except KeyError:
-                break
-            assert origin
-            headers.append(origin)
-
-            if hash_mode:  # hash traversal
-                if reverse:
-                    for i in xrange(skip+1):
-                        try:
-                            header = get_block(self.chain.db, origin_hash)
-                            origin_hash = header.prevhash
-                        except KeyError:
-                            unknown = True
-                            break
-                else:
-                    origin_hash = self.chain.get_blockhash_by_number(origin.number + skip + 1)
-                    try:
-                        header = get_block(self.chain.db, origin_hash)
-                        if self.chain.get_blockhashes_from_hash(header.hash, skip+1)[skip] == origin_hash:
-                            origin_hash = header.hash
-                        else:
-                            unknown = True
-                    except KeyError:
-                        unknown = True
-            else:  # number traversal
-                if reverse:
-                    if origin.number >= (skip+1):
-                        number = origin.number - (skip + 1)
-                        origin_hash = self.chain.get_blockhash_by_number(number)
-                    else:
-                        unknown = True
-                else:
-                    number = origin.number + skip + 1
-                    try:
-                        origin_hash = self.chain.get_blockhash_by_number(number)
-                    except KeyError:
-                        unknown = True
-
+        headers = self.header_cache.range(origin, max_hashes, skip, reverse)
         log.debug("sending: found blockheaders", count=len(headers))
         proto.send_blockheaders(*headers)
 
@@ -558,10 +824,11 @@ class ChainService(WiredService):
         log.debug("on_receive_getblockbodies", count=len(blockhashes))
         found = []
         for bh in blockhashes[:self.wire_protocol.max_getblocks_count]:
-            try:
-                found.append(self.chain.db.get(bh))
-            except KeyError:
+            body = self.body_cache.get(bh)
+            if body is None:
                 log.debug("unknown block requested", block_hash=encode_hex(bh))
+            else:
+                found.append(body)
         if found:
             log.debug("found", count=len(found))
             proto.send_blockbodies(*found)
@@ -576,3 +843,60 @@ class ChainService(WiredService):
         log.debug('----------------------------------')
         log.debug("recv newblock", block=block, remote_id=proto)
         self.synchronizer.receive_newblock(proto, block, chain_difficulty)
+
+    def on_receive_compactblock(self, proto, header, short_ids, uncles, chain_difficulty):
+        log.debug('----------------------------------')
+        log.debug("recv compactblock", num=header.number, txs=len(short_ids), remote_id=proto)
+        if self.compact_blocks_enabled(proto):
+            id_length = self.wire_protocol.compactblock.short_id_length
+            pool = dict((item.tx.hash[:id_length], item.tx)
+                        for item in self.transaction_queue.txs)
+            transactions = [pool.get(short_id) for short_id in short_ids]
+        else:  # not agreed on, only use it as an announcement
+            transactions = [None]
+        if None in transactions or tx_list_root(transactions) != header.tx_list_root:
+            self.compact_block_stats['fetched'] += 1
+            log.debug('cannot rebuild compactblock, fetching it',
+                      missing=transactions.count(None), **self.compact_block_stats)
+            announcement = self.wire_protocol.newblockhashes.Data(header.hash, header.number)
+            self.synchronizer.receive_newblockhashes(proto, [announcement])
+            return
+        self.compact_block_stats['rebuilt'] += 1
+        t_block = eth_protocol.TransientBlock(header, transactions, uncles, time.time())
+        self.synchronizer.receive_newblock(proto, t_block, chain_difficulty)
+
+    # fast sync ##############
+
+    def on_receive_getnodedata(self, proto, hashes):
+        log.debug('----------------------------------')
+        log.debug("on_receive_getnodedata", count=len(hashes))
+        found = []
+        for h in hashes[:self.wire_protocol.max_getnodedata_count]:
+            try:
+                found.append(self.chain.db.get(h))
+            except KeyError:
+                log.debug("unknown node requested", hash=encode_hex(h))
+        proto.send_nodedata(*found)
+
+    def on_receive_getreceipts(self, proto, blockhashes):
+        log.debug('----------------------------------')
+        log.debug("on_receive_getreceipts", count=len(blockhashes))
+        found = []
+        for bh in blockhashes[:self.wire_protocol.max_getreceipts_count]:
+            receipts = self.receipts.get_raw(bh, compute=False)  # no execution for peers
+            if receipts is None:
+                log.debug("unknown receipts requested", block_hash=encode_hex(bh))
+            else:
+                found.append(receipts)
+        proto.send_receipts(*found)
+
+
+class CompactBlocksService(WiredService):
+
+    """
+    Announces the compact blocks capability, registered if `eth.block_relay.compact`
+    is set. ChainService sends compactblock to the peers which announce it too.
+    """
+    name = 'compact_blocks'
+    default_config = dict()  # enabled by eth.block_relay.compact of ChainService
+    wire_protocol = eth_protocol.CompactBlocksProtocol
@@ -0,0 +1,112 @@
+# -*- coding: utf8 -*-
+"""
+Verification of the ethash seals of many headers at once.
+
+The headers of an epoch are hashed together with NumPy: every step of
+hashimoto runs over uint32 arrays holding the mixes of all headers, instead of
+per word Python integers. Only the keccak hashes are computed per header.
+NumPy is optional (`pip install pyethapp[numpy]`). Without it, or if ethpow
+uses the pyethash C implementation, the headers are checked one by one by
+`ethpow.check_pow`.
+"""
+from collections import defaultdict
+
+import gevent
+from ethereum import ethpow, ethash_utils
+from ethereum.slogging import get_logger
+from ethereum.utils import big_endian_to_int
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = get_logger('pow.batch')
+
+WORDS_PER_HASH = ethash_utils.HASH_BYTES // ethash_utils.WORD_BYTES
+
+
+def fnv(v1, v2):
+    "elementwise on uint32 arrays, wraps like the 32 bit original"
+    return v1 * np.uint32(ethash_utils.FNV_PRIME) ^ v2
+
+
+def sha3_512_rows(words):
+    return np.array([ethash_utils.sha3_512(row) for row in words.tolist()], dtype=np.uint32)
+
+
+def cache_array(cache):
+    "the ethash cache as (n, 16) uint32 array, cache files are used without copying"
+    if hasattr(cache, 'data'):  # MappedCache
+        return np.frombuffer(cache.data, dtype='<u4').reshape(-1, WORDS_PER_HASH)
+    if isinstance(cache, bytes):
+        return np.frombuffer(cache, dtype='<u4').reshape(-1, WORDS_PER_HASH)
+    return np.array(cache, dtype=np.uint32)
+
+
+def calc_dataset_items(cache, indices):
+    "`ethash.calc_dataset_item` for an array of indices"
+    n = len(cache)
+    mix = cache[indices % n]  # fancy indexing copies
+    mix[:, 0] ^= indices
+    mix = sha3_512_rows(mix)
+    for j in range(ethash_utils.DATASET_PARENTS):
+        parents = fnv(indices ^ np.uint32(j), mix[:, j % WORDS_PER_HASH]) % n
+        mix = fnv(mix, cache[parents])
+    return sha3_512_rows(mix)
+
+
+def hashimoto_light_batch(block_number, cache, header_hashes, nonces):
+    """
+    `ethash.hashimoto_light` for headers of the same epoch, returns a list of
+    `(mix_digest, result)`.
+    """
+    full_size = ethash_utils.get_full_size(block_number)
+    n = full_size // ethash_utils.HASH_BYTES
+    w = ethash_utils.MIX_BYTES // ethash_utils.WORD_BYTES
+    mixhashes = ethash_utils.MIX_BYTES // ethash_utils.HASH_BYTES
+    num = len(header_hashes)
+    s = np.array([ethash_utils.sha3_512(h + nonce[::-1])
+                  for h, nonce in zip(header_hashes, nonces)], dtype=np.uint32)
+    mix = np.tile(s, (1, mixhashes))
+    for i in range(ethash_utils.ACCESSES):
+        p = fnv(np.uint32(i) ^ s[:, 0], mix[:, i % w]) % (n // mixhashes) * mixhashes
+        indices = np.concatenate([p + np.uint32(j) for j in range(mixhashes)])
+        items = calc_dataset_items(cache, indices)
+        mix = fnv(mix, np.hstack([items[j * num:(j + 1) * num] for j in range(mixhashes)]))
+    cmix = fnv(fnv(fnv(mix[:, 0::4], mix[:, 1::4]), mix[:, 2::4]), mix[:, 3::4])
+    outputs = []
+    for s_words, cmix_words in zip(s.tolist(), cmix.tolist()):
+        outputs.append((ethash_utils.serialize_hash(cmix_words),
+                        ethash_utils.serialize_hash(ethash_utils.sha3_256(s_words + cmix_words))))
+    return outputs
+
+
+def check_pow_batch(headers, chunk_size=64):
+    """
+    Returns for each header if its seal is valid. Chunks of `chunk_size`
+    headers are hashed at once, the hub is served in between.
+    """
+    if np is None or getattr(ethpow, 'ETHASH_LIB', None) == 'pyethash':
+        return [ethpow.check_pow(h.number, h.mining_hash, h.mixhash, h.nonce, h.difficulty)
+                for h in headers]
+    valid = [False] * len(headers)
+    by_epoch = defaultdict(list)
+    for i, h in enumerate(headers):
+        if len(h.mixhash) == 32 and len(h.nonce) == 8:
+            by_epoch[h.number // ethpow.EPOCH_LENGTH].append(i)
+    for indices in by_epoch.values():
+        block_number = headers[indices[0]].number
+        cache = cache_array(ethpow.get_cache(block_number))
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start:start + chunk_size]
+            outputs = hashimoto_light_batch(block_number, cache,
+                                            [headers[i].mining_hash for i in chunk],
+                                            [headers[i].nonce for i in chunk])
+            for i, (mix_digest, result) in zip(chunk, outputs):
+                h = headers[i]
+                valid[i] = mix_digest == h.mixhash and \
+                    big_endian_to_int(result) <= 2**256 // (h.difficulty or 1)
+            gevent.sleep(0)
+    log.debug('checked seals', num=len(headers), invalid=valid.count(False))
+    return valid
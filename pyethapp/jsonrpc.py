@@ -1,6 +1,5 @@
 import os
 import inspect
-from copy import deepcopy
 from collections import Iterable
 
 import ethereum.bloom as bloom
@@ -11,8 +10,8 @@ import ethereum.slogging as slogging
 from ethereum.slogging import LogRecorder
 from ethereum.block import Block
 from ethereum.transactions import Transaction
-from ethereum.parse_genesis_declaration import mk_genesis_block
 from ethereum import processblock
+from ethereum import ethpow
 import gevent
 import gevent.queue
 import gevent.wsgi
@@ -22,14 +21,15 @@ from accounts import Account
 from devp2p.service import BaseService
 from ethereum import processblock
 from ethereum.exceptions import InvalidTransaction
+from ethereum.state_transition import apply_transaction
 from ethereum.slogging import LogRecorder
 from ethereum.transactions import Transaction
-from ethereum.trie import Trie
 from ethereum.utils import (
     big_endian_to_int, decode_hex, denoms, encode_hex, int_to_big_endian, is_numeric,
     is_string, int32, sha3, zpad,
 )
 from eth_protocol import ETHProtocol
+from pow_service import EthashCache
 from ipc_rpc import bind_unix_listener, serve
 from tinyrpc.dispatch import public as public_
 from tinyrpc.dispatch import RPCDispatcher
@@ -164,7 +164,7 @@ class RPCServer(BaseService):
 
     @classmethod
     def subdispatcher_classes(cls):
-        return (Web3, Personal, Net, Compilers, DB, Chain, Miner, FilterManager)
+        return (Web3, Personal, Net, Compilers, DB, Debug, Chain, Miner, MinerStats, FilterManager)
 
     def get_block(self, block_id=None):
         """Return the block identified by `block_id`.
@@ -511,6 +511,13 @@ def tx_encoder(transaction, block, i, pending):
     }
 
 
+def work_encoder(block):
+    """Encode the work of `block` as `[mining hash, seed hash, boundary]`."""
+    seed = EthashCache.seed(block.number // ethpow.EPOCH_LENGTH)
+    return [data_encoder(block.mining_hash), data_encoder(seed),
+            data_encoder(zpad(int_to_big_endian(2 ** 256 // block.difficulty), 32))]
+
+
 def loglist_encoder(loglist):
     """Encode a list of log"""
     # l = []
@@ -533,7 +540,7 @@ def loglist_encoder(loglist):
     return result
 
 
-def filter_decoder(filter_dict, chain):
+def filter_decoder(filter_dict, chain, receipts):
     """Decodes a filter as expected by eth_newFilter or eth_getLogs to a :class:`Filter`."""
     if not isinstance(filter_dict, dict):
         raise BadRequestError('Filter must be an object')
@@ -590,7 +597,7 @@ def filter_decoder(filter_dict, chain):
     if range_[0] > range_[1]:
         raise JSONRPCInvalidParamsError('fromBlock must not be newer than toBlock')
 
-    return LogFilter(chain, from_block, to_block, addresses, topics)
+    return LogFilter(chain, receipts, from_block, to_block, addresses, topics)
 
 
 def decode_arg(name, decoder):
@@ -750,6 +757,7 @@ class Compilers(Subdispatcher):
 class Miner(Subdispatcher):
 
     prefix = 'eth_'
+    max_poll_timeout = 60
 
     @public
     def mining(self):
@@ -757,6 +765,11 @@ class Miner(Subdispatcher):
             return self.app.services.pow.active
         return False
 
+    def _pow(self):
+        if 'pow' not in self.app.services:
+            raise MethodNotFoundError()
+        return self.app.services.pow
+
     @public
     @encode_res(quantity_encoder)
     def hashrate(self):
@@ -764,6 +777,39 @@ class Miner(Subdispatcher):
             return self.app.services.pow.hashrate
         return 0
 
+    @public
+    def getWork(self):
+        """Return the current work as `[mining hash, seed hash, boundary]`."""
+        block = self._pow().work.current
+        if block is None:
+            raise BadRequestError('No work available')
+        return work_encoder(block)
+
+    @public
+    @decode_arg('mining_hash', data_decoder)
+    def pollWork(self, mining_hash, timeout=30):
+        """Long poll for work: wait up to `timeout` seconds for work with another
+        mining hash than `mining_hash` (may be empty) and return it, or `None`.
+        """
+        block = self._pow().work.wait(mining_hash, min(timeout, self.max_poll_timeout))
+        if block is not None:
+            return work_encoder(block)
+
+    @public
+    @decode_arg('nonce', data_decoder)
+    @decode_arg('mining_hash', data_decoder)
+    @decode_arg('mix_digest', data_decoder)
+    def submitWork(self, nonce, mining_hash, mix_digest):
+        """Submit a solution for any recent work, return if it was accepted."""
+        return self._pow().submit_work(nonce, mix_digest, mining_hash)
+
+    @public
+    @decode_arg('hashrate', quantity_decoder)
+    def submitHashrate(self, hashrate, miner_id):
+        """Report the hashrate of an external miner identified by `miner_id`."""
+        self._pow().work.submit_hashrate(miner_id, hashrate)
+        return True
+
     @public
     @encode_res(address_encoder)
     def coinbase(self):
@@ -782,6 +828,20 @@ class Miner(Subdispatcher):
             [address_encoder(account.address) for account in self.app.services.accounts]
 
 
+class MinerStats(Subdispatcher):
+
+    """Subdispatcher exposing mining metrics."""
+
+    prefix = 'miner_'
+    required_services = ['pow']
+
+    @public
+    def stats(self):
+        """Smoothed hashrates in total, per worker and per external miner, stale
+        work, and the latency of candidate building and of broadcasting solutions."""
+        return self.pow.stats()
+
+
 class DB(Subdispatcher):
 
     """Subdispatcher providing database related RPC methods."""
@@ -816,6 +876,26 @@ class DB(Subdispatcher):
             return ''
 
 
+class Debug(Subdispatcher):
+
+    """Subdispatcher exposing internal performance counters."""
+
+    prefix = 'debug_'
+    required_services = ['chain']
+
+    @public
+    def blockProcessingStats(self):
+        """Latency percentiles in seconds per block processing phase."""
+        return self.chain.block_pipeline.stats()
+
+    @public
+    def protocolStats(self):
+        """Eth protocol messages, bytes and decode time per command and the
+        latency of header and body requests, in total and per peer, and how
+        many received compact blocks were rebuilt from the pool."""
+        return self.chain.protocol_stats()
+
+
 class Chain(Subdispatcher):
 
     """Subdispatcher for methods to query the block chain."""
@@ -1000,16 +1080,6 @@ class Chain(Subdispatcher):
             return None
         return block_encoder(uncle, is_header=True)
 
-    @public
-    def getWork(self):
-        print 'Sending work...'
-        h = self.chain.chain.head_candidate
-        return [
-            encode_hex(h.header.mining_hash),
-            encode_hex(h.header.seed),
-            encode_hex(zpad(int_to_big_endian(2 ** 256 // h.header.difficulty), 32))
-        ]
-
     @public
     def test(self, nonce):
         print 80808080808
@@ -1028,31 +1098,6 @@ class Chain(Subdispatcher):
             return min(tx.gasprice for tx in txs)
         return 0
 
-    @public
-    @decode_arg('nonce', data_decoder)
-    @decode_arg('mining_hash', data_decoder)
-    @decode_arg('mix_digest', data_decoder)
-    def submitWork(self, nonce, mining_hash, mix_digest):
-        print 'submitting work'
-        h = self.chain.chain.head_candidate
-        print 'header: %s' % encode_hex(rlp.encode(h))
-        if h.header.mining_hash != mining_hash:
-            return False
-        print 'mining hash: %s' % encode_hex(mining_hash)
-        print 'nonce: %s' % encode_hex(nonce)
-        print 'mixhash: %s' % encode_hex(mix_digest)
-        print 'seed: %s' % encode_hex(h.header.seed)
-        h.header.nonce = nonce
-        h.header.mixhash = mix_digest
-        if not self.chain.check_header(h.header):
-            print 'PoW check false'
-            return False
-        print 'PoW check true'
-        self.chain.chain.add_block(h)
-        self.chain.broadcast_newblock(h)
-        print 'Added: %d' % h.header.number
-        return True
-
     @public
     @encode_res(data_encoder)
     def coinbase(self):
@@ -1149,39 +1194,28 @@ class Chain(Subdispatcher):
         # relay the information along to the sendTransaction method for processing
         return self.sendTransaction(tx_dict)
 
-    @public
-    @decode_arg('block_id', block_id_decoder)
-    @encode_res(data_encoder)
-    def call(self, data, block_id='pending'):
-        block = self.json_rpc_server.get_block(block_id)
-        snapshot_before = block.snapshot()
-        tx_root_before = snapshot_before['txs'].root_hash  # trie object in snapshot is mutable
-
-        # rebuild block state before finalization
-        if block.has_parent():
-            parent = block.get_parent()
-            test_block = block.init_from_parent(parent, block.coinbase,
-                                                timestamp=block.timestamp)
-            for tx in block.get_transactions():
-                success, output = processblock.apply_transaction(test_block, tx)
-                assert success
-        else:
-            env = ethereum.config.Env(db=block.db)
-            test_block = mk_genesis_block(env)
-            original = {key: value for key, value in snapshot_before.items() if key != 'txs'}
-            original = deepcopy(original)
-            original['txs'] = Trie(snapshot_before['txs'].db, snapshot_before['txs'].root_hash)
-            test_block = mk_genesis_block(env)
-            test_block.revert(original)
-
-        # validate transaction
+    def _call_state(self, block_id):
+        """Return a disposable post state of the block identified by `block_id`,
+        for `'pending'` the head candidate being mined, if any.
+        """
+        block = None
+        if block_id == 'pending' and 'pow' in self.app.services:
+            block = self.app.services.pow.head_candidate
+            if block is not None and block.header.prevhash != self.chain.chain.head_hash:
+                block = None  # outdated
+        if block is None:
+            block = self.json_rpc_server.get_block('latest' if block_id == 'pending' else block_id)
+        return self.chain.post_states.view(block)
+
+    def _call_transaction(self, data, state):
+        """Return the unsigned transaction described by the call object `data`."""
         if not isinstance(data, dict):
             raise BadRequestError('Transaction must be an object')
         to = address_decoder(data['to'])
         try:
             startgas = quantity_decoder(data['gas'])
         except KeyError:
-            startgas = test_block.gas_limit - test_block.gas_used
+            startgas = state.gas_limit - state.gas_used
         try:
             gasprice = quantity_decoder(data['gasPrice'])
         except KeyError:
@@ -1198,21 +1232,20 @@ class Chain(Subdispatcher):
             sender = address_decoder(data['from'])
         except KeyError:
             sender = '\x00' * 20
-
-        # apply transaction
-        nonce = test_block.get_nonce(sender)
-        tx = Transaction(nonce, gasprice, startgas, to, value, data_)
+        tx = Transaction(state.get_nonce(sender), gasprice, startgas, to, value, data_)
         tx.sender = sender
+        return tx
 
+    @public
+    @decode_arg('block_id', block_id_decoder)
+    @encode_res(data_encoder)
+    def call(self, data, block_id='pending'):
+        state = self._call_state(block_id)
+        tx = self._call_transaction(data, state)
         try:
-            success, output = processblock.apply_transaction(test_block, tx)
+            success, output = apply_transaction(state, tx)
         except InvalidTransaction:
             success = False
-        # make sure we didn't change the real state
-        snapshot_after = block.snapshot()
-        assert snapshot_after == snapshot_before
-        assert snapshot_after['txs'].root_hash == tx_root_before
-
         if success:
             return output
         else:
@@ -1222,67 +1255,12 @@ class Chain(Subdispatcher):
     @decode_arg('block_id', block_id_decoder)
     @encode_res(quantity_encoder)
     def estimateGas(self, data, block_id='pending'):
-        block = self.json_rpc_server.get_block(block_id)
-        snapshot_before = block.snapshot()
-        tx_root_before = snapshot_before['txs'].root_hash  # trie object in snapshot is mutable
-
-        # rebuild block state before finalization
-        if block.has_parent():
-            parent = block.get_parent()
-            test_block = block.init_from_parent(parent, block.coinbase,
-                                                timestamp=block.timestamp)
-            for tx in block.get_transactions():
-                success, output = processblock.apply_transaction(test_block, tx)
-                assert success
-        else:
-            env = ethereum.config.Env(db=block.db)
-            test_block = mk_genesis_block(env)
-            original = {key: value for key, value in snapshot_before.items() if key != 'txs'}
-            original = deepcopy(original)
-            original['txs'] = Trie(snapshot_before['txs'].db, snapshot_before['txs'].root_hash)
-            test_block = mk_genesis_block(env)
-            test_block.revert(original)
-
-        # validate transaction
-        if not isinstance(data, dict):
-            raise BadRequestError('Transaction must be an object')
-        to = address_decoder(data['to'])
-        try:
-            startgas = quantity_decoder(data['gas'])
-        except KeyError:
-            startgas = block.gas_limit - block.gas_used
-        try:
-            gasprice = quantity_decoder(data['gasPrice'])
-        except KeyError:
-            gasprice = 0
-        try:
-            value = quantity_decoder(data['value'])
-        except KeyError:
-            value = 0
-        try:
-            data_ = data_decoder(data['data'])
-        except KeyError:
-            data_ = b''
-        try:
-            sender = address_decoder(data['from'])
-        except KeyError:
-            sender = '\x00' * 20
-
-        # apply transaction
-        nonce = test_block.get_nonce(sender)
-        tx = Transaction(nonce, gasprice, startgas, to, value, data_)
-        tx.sender = sender
-
-        try:
-            success, output = processblock.apply_transaction(test_block, tx)
-        except InvalidTransaction:
-            success = False
-        # make sure we didn't change the real state
-        snapshot_after = block.snapshot()
-        assert snapshot_after == snapshot_before
-        assert snapshot_after['txs'].root_hash == tx_root_before
-
-        return test_block.gas_used - block.gas_used
+        state = self._call_state(block_id)
+        tx = self._call_transaction(data, state)
+        gas = self.chain.gas_estimator.estimate(state, tx)
+        if gas is None:
+            raise BadRequestError('Transaction fails with all gas')
+        return gas
 
 
 class LogFilter(object):
@@ -1290,6 +1268,7 @@ class LogFilter(object):
     """A filter for logs.
 
     :ivar chain: the blockchain object
+    :ivar receipts: the `ReceiptsStore` of the chain service
     :ivar first_block: number of the first block to check or 'latest', 'pending', 'earliest'
     :ivar last_block: number of the last block to check or 'latest', 'pending', 'earliest'
     :ivar addresses: a list of contract addresses or None to not consider addresses
@@ -1301,8 +1280,9 @@ class LogFilter(object):
                               logs again or `None` if no block has been checked yet
     """
 
-    def __init__(self, chain, first_block, last_block, addresses=None, topics=None):
+    def __init__(self, chain, receipts, first_block, last_block, addresses=None, topics=None):
         self.chain = chain
+        self.receipts = receipts
         assert is_numeric(first_block) or first_block in ('latest', 'pending', 'earliest')
         assert is_numeric(last_block) or last_block in ('latest', 'pending', 'earliest')
         self.first_block = first_block
@@ -1414,7 +1394,10 @@ class LogFilter(object):
                 print 'bloom filter passed'
             logger.debug('-')
             logger.debug('with block', block=block)
-            receipts = block.get_receipts()
+            if block == self.chain.head_candidate:
+                receipts = block.get_receipts()
+            else:
+                receipts = self.receipts.get(block.hash) or []
             logger.debug('receipts', block=block, receipts=receipts)
             for r_idx, receipt in enumerate(receipts):  # one receipt per tx
                 for l_idx, log in enumerate(receipt.logs):
@@ -1550,7 +1533,7 @@ class FilterManager(Subdispatcher):
     @public
     @encode_res(quantity_encoder)
     def newFilter(self, filter_dict):
-        filter_ = filter_decoder(filter_dict, self.chain.chain)
+        filter_ = filter_decoder(filter_dict, self.chain.chain, self.chain.receipts)
         self.filters[self.next_id] = filter_
         self.next_id += 1
         return self.next_id - 1
@@ -1608,7 +1591,7 @@ class FilterManager(Subdispatcher):
     @public
     @encode_res(loglist_encoder)
     def getLogs(self, filter_dict):
-        filter_ = filter_decoder(filter_dict, self.chain.chain)
+        filter_ = filter_decoder(filter_dict, self.chain.chain, self.chain.receipts)
         return filter_.logs
 
     # ########### Trace ############
@@ -1676,7 +1659,10 @@ class FilterManager(Subdispatcher):
             return None
         if not self.chain.chain.in_main_branch(block):
             return None
-        receipt = block.get_receipt(index)
+        receipts = self.chain.receipts.get(block.hash)
+        if receipts is None:
+            return None
+        receipt = receipts[index]
         response = {
             'transactionHash': data_encoder(tx.hash),
             'transactionIndex': quantity_encoder(index),
@@ -1688,7 +1674,7 @@ class FilterManager(Subdispatcher):
         if index == 0:
             response['gasUsed'] = quantity_encoder(receipt.gas_used)
         else:
-            prev_receipt = block.get_receipt(index - 1)
+            prev_receipt = receipts[index - 1]
             assert prev_receipt.gas_used < receipt.gas_used
             response['gasUsed'] = quantity_encoder(receipt.gas_used - prev_receipt.gas_used)
 
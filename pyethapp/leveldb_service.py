@@ -90,6 +90,10 @@ class LevelDB(BaseDB):
         self.uncommitted[key] = o
         return o
 
+    def get_committed(self, key):
+        "reads the committed value, leaves the write cache untouched"
+        return decompress(self.db.Get(key))
+
     def put(self, key, value):
         log.trace('putting entry', key=key.encode('hex')[:8], len=len(value))
         self.uncommitted[key] = value
@@ -80,6 +80,14 @@ class LmDBService(BaseDB, BaseService):
 
         return value
 
+    def get_committed(self, key):
+        "reads the committed value, leaves the write cache untouched"
+        with self.env.begin(write=False) as transaction:
+            value = transaction.get(key, NULL)
+        if value is NULL:
+            raise KeyError('key not in db')
+        return value
+
     def commit(self):
         keys_to_delete = (
             key
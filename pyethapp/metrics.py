@@ -0,0 +1,180 @@
+# -*- coding: utf8 -*-
+import math
+import time
+from collections import defaultdict, deque
+
+
+class LatencyHistogram(object):
+
+    """
+    Streaming latency histogram in the style of HdrHistogram.
+
+    Values are counted in buckets of `2 ** sub_bits` linear sub-buckets per
+    power of two, so the relative error of a reported percentile is below
+    `2 ** -sub_bits`. Adding a value is O(1), percentiles are computed on read.
+    """
+
+    def __init__(self, unit=1e-6, sub_bits=4, max_bits=40):
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.sub_buckets = 1 << sub_bits
+        self.counts = [0] * ((max_bits - sub_bits + 1) * self.sub_buckets)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        v = int(value / self.unit)
+        if v < 2 * self.sub_buckets:
+            return max(v, 0)
+        shift = v.bit_length() - self.sub_bits - 1
+        return min(shift * self.sub_buckets + (v >> shift), len(self.counts) - 1)
+
+    def _value(self, index):
+        "midpoint of the bucket at `index`"
+        shift = max(index // self.sub_buckets - 1, 0)
+        lower = (index - shift * self.sub_buckets) << shift
+        return (lower + ((1 << shift) - 1) / 2.) * self.unit
+
+    def add(self, value):
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.
+        rank = max(1, int(round(self.count * pct / 100.)))
+        seen = 0
+        for index, num in enumerate(self.counts[:-1]):
+            seen += num
+            if seen >= rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max  # the last bucket also holds all values beyond the range
+
+    def summary(self):
+        return dict(count=self.count, mean=self.mean, min=self.min or 0., max=self.max or 0.,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99), p999=self.percentile(99.9))
+
+
+class CommandMetrics(object):
+
+    "message and byte counts of a single protocol command"
+
+    def __init__(self):
+        self.received = 0
+        self.bytes_in = 0
+        self.decode_time = 0.
+        self.sent = 0
+        self.bytes_out = 0
+
+    def summary(self):
+        return dict(received=self.received, bytes_in=self.bytes_in, sent=self.sent,
+                    bytes_out=self.bytes_out, decode_time=self.decode_time)
+
+
+class ProtocolMetrics(object):
+
+    """
+    Per command traffic of a protocol connection, also counted in `total` if
+    given. The latency of `requests` is measured up to their reply, replies are
+    matched to the oldest outstanding request of the connection.
+    """
+
+    requests = dict(getblockheaders='blockheaders', getblockbodies='blockbodies')
+    max_outstanding = 16
+
+    def __init__(self, total=None):
+        self.total = total
+        self.commands = defaultdict(CommandMetrics)
+        self.latency = defaultdict(LatencyHistogram)  # request: round trip time
+        self.outstanding = dict((reply, deque(maxlen=self.max_outstanding))
+                                for reply in self.requests.values())
+
+    def _targets(self):
+        return (self, self.total) if self.total else (self,)
+
+    def on_receive(self, command, num_bytes, decode_time):
+        for m in self._targets():
+            c = m.commands[command]
+            c.received += 1
+            c.bytes_in += num_bytes
+            c.decode_time += decode_time
+        if self.outstanding.get(command):
+            elapsed = time.time() - self.outstanding[command].popleft()
+            request = [r for r, reply in self.requests.items() if reply == command][0]
+            for m in self._targets():
+                m.latency[request].add(elapsed)
+
+    def on_send(self, command, num_bytes):
+        for m in self._targets():
+            c = m.commands[command]
+            c.sent += 1
+            c.bytes_out += num_bytes
+        if command in self.requests:
+            self.outstanding[self.requests[command]].append(time.time())
+
+    def summary(self):
+        return dict(commands=dict((name, c.summary()) for name, c in self.commands.items()),
+                    requests=dict((name, h.summary()) for name, h in self.latency.items()))
+
+
+class MovingAverage(object):
+
+    """
+    Exponential moving average of samples taken at irregular intervals. The
+    weight of a sample decays with `exp(-age / tau)`, `tau` in seconds.
+    """
+
+    def __init__(self, tau=10.):
+        self.tau = tau
+        self.value = 0.
+        self.last = None
+
+    def add(self, value, now=None):
+        now = time.time() if now is None else now
+        if self.last is None:
+            self.value = float(value)
+        else:
+            alpha = 1 - math.exp(-max(now - self.last, 0) / self.tau)
+            self.value += alpha * (value - self.value)
+        self.last = now
+
+
+class MiningMetrics(object):
+
+    """
+    Smoothed hashrate per mining worker, the number of jobs replaced before
+    being solved (stale work), and the latency of building and updating the
+    head candidate and from a solution to the broadcast of its block.
+    """
+
+    def __init__(self, tau=10.):
+        self.hashrates = defaultdict(lambda: MovingAverage(tau))  # worker_id: hashrate
+        self.stale_work = 0
+        self.solutions = 0
+        self.latency = dict((name, LatencyHistogram())
+                            for name in ('build', 'update', 'submit_to_broadcast'))
+
+    def on_hashrate(self, worker_id, hashrate):
+        self.hashrates[worker_id].add(hashrate)
+
+    @property
+    def hashrate(self):
+        return int(sum(h.value for h in self.hashrates.values()))
+
+    def summary(self):
+        workers = dict((worker_id, int(h.value)) for worker_id, h in self.hashrates.items())
+        return dict(hashrate=self.hashrate, workers=workers,
+                    stale_work=self.stale_work, solutions=self.solutions,
+                    latency=dict((name, h.summary()) for name, h in self.latency.items()))
@@ -1,35 +1,160 @@
+import copy
+import mmap
+import multiprocessing
+import os
+import struct
 import time
 import gevent
 import gipc
 import random
+from gevent.event import Event
 from devp2p.service import BaseService
-from ethereum.block_creation import make_head_candidate
+from ethereum import ethpow
+from ethereum.block import Block
+from ethereum.block_creation import make_head_candidate, add_transactions
+from ethereum.state_transition import initialize, finalize, set_execution_results
 from ethereum.ethpow import mine, TT64M1
 from ethereum.slogging import get_logger
-from ethereum.utils import encode_hex
+from ethereum.utils import encode_hex, sha3
+from pyethapp.metrics import MiningMetrics
+from pyethapp.work_server import WorkServer
 log = get_logger('pow')
 log_sub = get_logger('pow.subprocess')
 
 
+def generate_cache_file(path, block_number):
+    "entry point of the sub process writing the ethash cache of an epoch"
+    cache = ethpow.mkcache(block_number)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        if isinstance(cache, bytes):  # pyethash
+            f.write(cache)
+        else:
+            for item in cache:
+                f.write(struct.pack('<16I', *item))
+    os.rename(tmp_path, path)
+
+
+class MappedCache(object):
+
+    "the items of a memory-mapped ethash cache file, as lists of 16 words"
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data) // 64
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return list(struct.unpack_from('<16I', self.data, i * 64))
+
+
+class EthashCache(object):
+
+    """
+    Ethash caches stored as files in `directory`, one per epoch. Installed
+    caches are memory-mapped and used by `ethpow.mine` and `ethpow.check_pow`
+    instead of computing them in memory on every start. The files are generated
+    in a sub process, the next epoch's in the background ahead of time.
+    """
+
+    def __init__(self, directory, epochs_kept=3):
+        self.directory = directory
+        self.epochs_kept = epochs_kept
+        self.generators = dict()  # epoch: process
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    seeds = ['\x00' * 32]
+
+    @classmethod
+    def seed(cls, epoch):
+        while len(cls.seeds) <= epoch:
+            cls.seeds.append(sha3(cls.seeds[-1]))
+        return cls.seeds[epoch]
+
+    def path(self, epoch):
+        name = 'cache-%d-%s' % (epoch, encode_hex(self.seed(epoch))[:16])
+        return os.path.join(self.directory, name)
+
+    def generate(self, epoch, wait=True):
+        "starts generating the cache file of epoch unless it exists"
+        path = self.path(epoch)
+        if not os.path.exists(path) and epoch not in self.generators:
+            log.info('generating ethash cache', epoch=epoch)
+            self.generators[epoch] = gipc.start_process(
+                target=generate_cache_file, args=(path, epoch * ethpow.EPOCH_LENGTH))
+        if wait and epoch in self.generators:
+            self.generators.pop(epoch).join()  # cooperative
+        for e, process in self.generators.items():
+            if not process.is_alive():
+                del self.generators[e]
+                process.join()
+
+    def install(self, block_number):
+        "maps the cache file of the epoch of block_number for ethpow, returns success"
+        epoch = block_number // ethpow.EPOCH_LENGTH
+        seed = self.seed(epoch)
+        if seed in ethpow.cache_by_seed:
+            return True
+        path = self.path(epoch)
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        ethpow.cache_by_seed[seed] = data[:] if getattr(ethpow, 'ETHASH_LIB', None) == 'pyethash' \
+            else MappedCache(data)
+        while len(ethpow.cache_by_seed) > ethpow.cache_by_seed.max_items:
+            ethpow.cache_by_seed.popitem(last=False)
+        log.debug('installed ethash cache', epoch=epoch)
+        return True
+
+    def prepare(self, block_number, wait=True):
+        """
+        Installs the cache of the epoch of block_number, generating it if needed,
+        and pregenerates the next epoch's in the background. Without `wait` the
+        current epoch's cache is installed only if its file is ready. Returns if
+        it was installed.
+        """
+        epoch = block_number // ethpow.EPOCH_LENGTH
+        self.generate(epoch, wait)
+        installed = self.install(block_number)
+        self.generate(epoch + 1, wait=False)
+        self.prune(epoch)
+        return installed
+
+    def prune(self, epoch):
+        "removes the files of epochs before the kept ones"
+        keep = set(os.path.basename(self.path(e))
+                   for e in range(max(0, epoch - self.epochs_kept + 1), epoch + 2))
+        for name in os.listdir(self.directory):
+            if name.startswith('cache-') and name not in keep and not name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+
 class Miner(gevent.Greenlet):
 
     rounds = 100
     max_elapsed = 1.
 
     def __init__(self, mining_hash, block_number, difficulty, nonce_callback,
-                 hashrate_callback, cpu_pct=100):
+                 hashrate_callback, cpu_pct=100, start_nonce=None):
         self.mining_hash = mining_hash
         self.block_number = block_number
         self.difficulty = difficulty
         self.nonce_callback = nonce_callback
         self.hashrate_callback = hashrate_callback
         self.cpu_pct = cpu_pct
+        self.start_nonce = start_nonce
         self.last = time.time()
         self.is_stopped = False
         super(Miner, self).__init__()
 
     def _run(self):
-        nonce = random.randint(0, TT64M1)
+        nonce = self.start_nonce
+        if nonce is None:
+            nonce = random.randint(0, TT64M1)
         while not self.is_stopped:
             log_sub.trace('starting mining round')
             st = time.time()
@@ -45,7 +170,7 @@ class Miner(gevent.Greenlet):
             self.hashrate_callback(hashrate)
             log_sub.trace('sleeping', delay=delay, elapsed=elapsed, rounds=self.rounds)
             gevent.sleep(delay + 0.001)
-            nonce += self.rounds
+            nonce = (nonce + self.rounds) & TT64M1
             # adjust
             adjust = elapsed / self.max_elapsed
             self.rounds = int(self.rounds / adjust)
@@ -63,10 +188,12 @@ class PoWWorker(object):
     communicates with the parent process using: tuple(str_cmd, dict_kargs)
     """
 
-    def __init__(self, cpipe, cpu_pct):
+    def __init__(self, cpipe, cpu_pct, worker_id=0, ethash_dir=None):
         self.cpipe = cpipe
         self.miner = None
         self.cpu_pct = cpu_pct
+        self.worker_id = worker_id
+        self.ethash_cache = EthashCache(ethash_dir) if ethash_dir else None
 
     def send_found_nonce(self, bin_nonce, mixhash, mining_hash):
         log_sub.info('sending nonce')
@@ -75,23 +202,29 @@ class PoWWorker(object):
 
     def send_hashrate(self, hashrate):
         log_sub.trace('sending hashrate')
-        self.cpipe.put(('hashrate', dict(hashrate=hashrate)))
+        self.cpipe.put(('hashrate', dict(hashrate=hashrate, worker_id=self.worker_id)))
 
     def recv_set_cpu_pct(self, cpu_pct):
         self.cpu_pct = max(0, min(100, cpu_pct))
         if self.miner:
             self.miner.cpu_pct = self.cpu_pct
 
-    def recv_mine(self, mining_hash, block_number, difficulty):
+    def recv_mine(self, mining_hash, block_number, difficulty, start_nonce=None):
         "restarts the miner"
         log_sub.debug('received new mining task', difficulty=difficulty)
         assert isinstance(block_number, int)
-        if self.miner:
-            self.miner.stop()
+        self.recv_stop()
+        if self.ethash_cache:
+            self.ethash_cache.install(block_number)
         self.miner = Miner(mining_hash, block_number, difficulty, self.send_found_nonce,
-                           self.send_hashrate, self.cpu_pct)
+                           self.send_hashrate, self.cpu_pct, start_nonce)
         self.miner.start()
 
+    def recv_stop(self):
+        if self.miner:
+            self.miner.stop()
+            self.miner = None
+
     def run(self):
         while True:
             cmd, kargs = self.cpipe.get()
@@ -99,90 +232,275 @@ class PoWWorker(object):
             getattr(self, 'recv_' + cmd)(**kargs)
 
 
-def powworker_process(cpipe, cpu_pct):
+def powworker_process(cpipe, cpu_pct, worker_id=0, ethash_dir=None):
     "entry point in forked sub processes, setup env"
     gevent.get_hub().SYSTEM_ERROR = BaseException  # stop on any exception
-    PoWWorker(cpipe, cpu_pct).run()
+    PoWWorker(cpipe, cpu_pct, worker_id, ethash_dir).run()
 
 
 # parent process defined below ##############################################3
 
+class CandidateBuilder(object):
+
+    """
+    The block mined on top of the head. `rebuild` starts a new candidate on a
+    new head, `update` applies the transactions pooled since on top of the
+    current one without executing the included ones again.
+
+    The candidate's state is kept before `finalize`, every version handed to
+    the miners is finalized on an ephemeral clone of it.
+    """
+
+    def __init__(self, chain, txqueue):
+        self.chain = chain  # ethereum.chain.Chain
+        self.txqueue = txqueue
+        self.block = None  # not finalized
+        self.state = None
+
+    def rebuild(self):
+        if self.block:  # back to the pool, unless included in the new head
+            self.txqueue.restore(self.block.transactions)
+        # header and uncles, without transactions
+        self.block = make_head_candidate(self.chain, None)
+        self.state = self.chain.state.ephemeral_clone()
+        initialize(self.state, self.block)
+        add_transactions(self.state, self.block, self.txqueue)
+        return self.seal()
+
+    def update(self):
+        "returns the updated candidate, None if no transaction was added"
+        num_txs = len(self.block.transactions)
+        add_transactions(self.state, self.block, self.txqueue)
+        if len(self.block.transactions) > num_txs:
+            return self.seal()
+
+    def seal(self):
+        "a finalized copy of the candidate, ready for mining"
+        block = Block(copy.copy(self.block.header), list(self.block.transactions),
+                      self.block.uncles)
+        state = self.state.ephemeral_clone()
+        finalize(state, block)
+        set_execution_results(state, block)
+        return block
+
+
 class PoWService(BaseService):
 
     name = 'pow'
     default_config = dict(pow=dict(
         activated=False,
         cpu_pct=100,
+        workers=None,  # mining processes, default one per CPU, 0 for external miners only,
+                       # started with the first work to mine
+        ethash_dir='ethash',  # in data_dir, empty to not store caches
         coinbase_hex=None,
-        mine_empty_blocks=True
+        mine_empty_blocks=True,
+        candidate_update_delay=1.,  # collects new transactions before updating the work
     ))
 
     def __init__(self, app):
         super(PoWService, self).__init__(app)
-        cpu_pct = self.app.config['pow']['cpu_pct']
-        self.cpipe, self.ppipe = gipc.pipe(duplex=True)
-        self.worker_process = gipc.start_process(
-            target=powworker_process, args=(self.cpipe, cpu_pct))
+        self.num_workers = self.app.config['pow']['workers']
+        if self.num_workers is None:
+            self.num_workers = multiprocessing.cpu_count()
+        self.ethash_cache = None
+        if self.app.config['pow']['ethash_dir'] and 'data_dir' in self.app.config:
+            self.ethash_cache = EthashCache(os.path.join(self.app.config['data_dir'],
+                                                         self.app.config['pow']['ethash_dir']))
+        self.ppipes = []
+        self.worker_processes = []
+        self.receivers = []
+        self.workers_started = Event()
+        self.metrics = MiningMetrics()
         self.chain = app.services.chain
         self.chain.on_new_head_cbs.append(self.on_new_head)
-        self.hashrate = 0
+        self.chain.on_new_transaction_cbs.append(self.on_new_transaction)
+        self.candidate = CandidateBuilder(self.chain.chain, self.chain.transaction_queue)
         self.head_candidate = None
+        self.work = WorkServer()
+        self.candidate_update = None
+        self.cache_waiter = None
 
     @property
     def active(self):
         return self.app.config['pow']['activated']
 
+    @property
+    def hashrate(self):
+        "smoothed, summed over all workers and external miners"
+        return self.metrics.hashrate + self.work.hashrate
+
+    def stats(self):
+        "mining metrics, with the hashrates reported by external miners"
+        stats = self.metrics.summary()
+        stats['hashrate'] = self.hashrate
+        stats['miners'] = self.work.hashrates()
+        stats['jobs'] = len(self.work)
+        return stats
+
     def on_new_head(self, block):
+        if self.ethash_cache:  # for verifying headers, also if not mining
+            self.ethash_cache.prepare(block.number, wait=False)
         self.make_candidate_and_mine()
 
+    def on_new_transaction(self, tx):
+        if self.candidate_update is None:
+            self.candidate_update = gevent.spawn_later(
+                self.app.config['pow']['candidate_update_delay'], self.update_candidate_and_mine)
+
     def make_head_candidate(self):
         # This method exists only so that we can stub it in tests.
-        return make_head_candidate(self.chain.chain, self.chain.transaction_queue)
+        return self.candidate.rebuild()
+
+    def update_head_candidate(self):
+        # This method exists only so that we can stub it in tests.
+        return self.candidate.update()
+
+    def candidate_is_stale(self):
+        "if there is no head candidate or it is not on top of the head"
+        hc = self.head_candidate
+        return hc is None or hc.header.prevhash != self.chain.chain.head_hash
 
     def make_candidate_and_mine(self):
         if not self.active or self.chain.is_syncing:
             return
 
+        if self.work.current is not None:
+            self.metrics.stale_work += 1
+        self.work.clear()
+        st = time.time()
         self.head_candidate = self.make_head_candidate()
+        self.metrics.latency['build'].add(time.time() - st)
         hc = self.head_candidate
         if (hc.transaction_count == 0 and
                 not self.app.config['pow']['mine_empty_blocks']):
             return
+        self.mine(hc)
 
-        log.debug('mining', difficulty=hc.difficulty)
-        self.ppipe.put(('mine', dict(mining_hash=hc.mining_hash,
-                                     block_number=hc.number,
-                                     difficulty=hc.difficulty)))
+    def update_candidate_and_mine(self):
+        "pushes new work if transactions were added to the head candidate"
+        self.candidate_update = None
+        if not self.active or self.chain.is_syncing:
+            return
+        if self.candidate_is_stale():  # the head changed while not mining
+            return self.make_candidate_and_mine()
+        with self.chain.add_transaction_lock:
+            st = time.time()
+            hc = self.update_head_candidate()
+            self.metrics.latency['update'].add(time.time() - st)
+        if hc:
+            log.debug('updated head candidate', num_txs=hc.transaction_count)
+            self.head_candidate = hc
+            self.mine(hc)
+
+    def mine(self, hc):
+        if self.work.current is not None:
+            self.metrics.stale_work += 1
+        self.work.add(hc)
+        if not self.num_workers or self.cache_waiter is not None:
+            return
+        # called from new head callbacks, so don't wait for a new epoch's cache here
+        if self.ethash_cache and not self.ethash_cache.prepare(hc.number, wait=False):
+            self.cache_waiter = gevent.spawn(self.mine_when_cache_ready, hc.number)
+            return
+        self.send_work(hc)
+
+    def mine_when_cache_ready(self, block_number):
+        "waits for the cache of the epoch to be generated, then sends the current work"
+        self.ethash_cache.prepare(block_number)
+        self.cache_waiter = None
+        if self.work.current is not None:
+            self.send_work(self.work.current)
 
-    def recv_hashrate(self, hashrate):
-        log.trace('hashrate updated', hashrate=hashrate)
-        self.hashrate = hashrate
+    def start_workers(self):
+        "starts the mining processes, not before there is work for them"
+        cpu_pct = self.app.config['pow']['cpu_pct']
+        ethash_dir = self.ethash_cache.directory if self.ethash_cache else None
+        for worker_id in range(self.num_workers):
+            cpipe, ppipe = gipc.pipe(duplex=True)
+            self.ppipes.append(ppipe)
+            self.worker_processes.append(gipc.start_process(
+                target=powworker_process, args=(cpipe, cpu_pct, worker_id, ethash_dir)))
+        self.receivers = [gevent.spawn(self._receive, ppipe) for ppipe in self.ppipes]
+        self.workers_started.set()
+
+    def send_work(self, hc):
+        if not self.ppipes:
+            self.start_workers()
+        log.debug('mining', difficulty=hc.difficulty, workers=len(self.ppipes))
+        # disjoint nonce ranges, from a random offset
+        offset = random.randint(0, TT64M1)
+        span = (TT64M1 + 1) // len(self.ppipes)
+        for i, ppipe in enumerate(self.ppipes):
+            ppipe.put(('mine', dict(mining_hash=hc.mining_hash,
+                                    block_number=hc.number,
+                                    difficulty=hc.difficulty,
+                                    start_nonce=(offset + i * span) & TT64M1)))
+
+    def stop_workers(self):
+        for ppipe in self.ppipes:
+            ppipe.put(('stop', dict()))
+
+    def recv_hashrate(self, hashrate, worker_id=0):
+        log.trace('hashrate updated', hashrate=hashrate, worker_id=worker_id)
+        self.metrics.on_hashrate(worker_id, hashrate)
 
     def recv_found_nonce(self, bin_nonce, mixhash, mining_hash):
         log.info('nonce found', mining_hash=mining_hash.encode('hex'))
-        block = self.head_candidate
-        if block.mining_hash != mining_hash:
-            log.warn('mining_hash does not match')
-            self.make_candidate_and_mine()
+        block = self.work.get(mining_hash)
+        if block is None:
+            log.debug('mining_hash does not match, ignoring')  # found by another worker
             return
+        self.add_mined_block(block, bin_nonce, mixhash)
+
+    def submit_work(self, bin_nonce, mixhash, mining_hash):
+        "adds the block solved by an external miner, returns success"
+        block = self.work.get(mining_hash)
+        if block is None:
+            log.debug('unknown or stale work submitted', mining_hash=encode_hex(mining_hash))
+            return False
+        if not ethpow.check_pow(block.number, mining_hash, mixhash, bin_nonce, block.difficulty):
+            log.debug('invalid work submitted', mining_hash=encode_hex(mining_hash))
+            return False
+        return self.add_mined_block(block, bin_nonce, mixhash)
+
+    def add_mined_block(self, block, bin_nonce, mixhash):
+        st = time.time()
+        self.metrics.solutions += 1
+        self.work.clear()
+        self.stop_workers()
         block.mixhash = mixhash
         block.nonce = bin_nonce
-        if self.chain.add_mined_block(block):
+        added = self.chain.add_mined_block(block)  # broadcasts the block
+        if added:
+            self.metrics.latency['submit_to_broadcast'].add(time.time() - st)
             log.debug('mined block %d (%s) added to chain' % (
                 block.number, encode_hex(block.hash[:8])))
         else:
             log.debug('failed to add mined block %d (%s) to chain' % (
                 block.number, encode_hex(block.hash[:8])))
         self.make_candidate_and_mine()
+        return added
 
-    def _run(self):
-        self.make_candidate_and_mine()
+    def _receive(self, ppipe):
         while True:
-            cmd, kargs = self.ppipe.get()
+            cmd, kargs = ppipe.get()
             assert isinstance(kargs, dict)
             getattr(self, 'recv_' + cmd)(**kargs)
 
+    def _run(self):
+        self.make_candidate_and_mine()
+        self.workers_started.wait()
+        gevent.joinall(self.receivers, raise_error=True)
+
     def stop(self):
-        self.worker_process.terminate()
-        self.worker_process.join()
+        if self.candidate_update:
+            self.candidate_update.kill()
+        if self.cache_waiter:
+            self.cache_waiter.kill()
+        gevent.killall(self.receivers)
+        for process in self.worker_processes:
+            process.terminate()
+        for process in self.worker_processes:
+            process.join()
         super(PoWService, self).stop()
@@ -0,0 +1,65 @@
+# -*- coding: utf8 -*-
+import rlp
+from ethereum.slogging import get_logger
+from ethereum.state_transition import apply_block, Receipt
+
+log = get_logger('eth.receipts')
+
+
+class ReceiptsStore(object):
+
+    """
+    Receipts of blocks, stored as one encoded list per block under
+    'receipts:<blockhash>' in the chain db.
+
+    Receipts are saved as blocks become the head (`on_new_head`). The chain has
+    committed the block by then, so they are committed on their own. Receipts
+    of blocks added before are computed by re-executing the block once, on
+    request, and committed with the next block.
+    """
+
+    prefix = 'receipts:'
+    sedes = rlp.sedes.CountableList(Receipt)
+
+    def __init__(self, chain):
+        self.chain = chain
+
+    def on_new_head(self, block):
+        if block.header.hash == self.chain.head_hash:  # the state holds its receipts
+            self.put(block.header.hash, self.chain.state.receipts)
+            self.chain.db.commit()
+
+    def put(self, blockhash, receipts):
+        self.chain.db.put(self.prefix + blockhash, rlp.encode(receipts, self.sedes))
+
+    def get_raw(self, blockhash, compute=True):
+        "returns the encoded receipts of `blockhash` or None if unknown"
+        try:
+            return self.chain.db.get(self.prefix + blockhash)
+        except KeyError:
+            pass
+        if compute and self.compute(blockhash) is not None:
+            return self.chain.db.get(self.prefix + blockhash)
+
+    def get(self, blockhash):
+        "returns the receipts of `blockhash` or None if unknown"
+        receipts_rlp = self.get_raw(blockhash)
+        if receipts_rlp is not None:
+            return rlp.decode(receipts_rlp, self.sedes)
+
+    def compute(self, blockhash):
+        block = self.chain.get_block(blockhash)
+        if block is None:
+            return None
+        if block.header.number == 0:
+            receipts = []
+        else:
+            try:
+                state = self.chain.mk_poststate_of_blockhash(block.header.prevhash)
+                apply_block(state, block)
+            except Exception as e:
+                log.debug('cannot compute receipts', block=block, error=e)
+                return None
+            receipts = state.receipts
+        self.put(blockhash, receipts)
+        return receipts
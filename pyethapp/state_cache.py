@@ -0,0 +1,119 @@
+# -*- coding: utf8 -*-
+from collections import OrderedDict
+
+from ethereum.exceptions import InvalidTransaction
+from ethereum.slogging import get_logger
+from ethereum.state_transition import initialize, apply_transaction
+from ethereum.transactions import Transaction
+
+log = get_logger('eth.statecache')
+
+
+class PostStateCache(object):
+
+    """
+    LRU of block post states for running calls, keyed by `(block hash, state
+    root)`. `view` returns a copy-on-write clone, so a call only pays for its
+    own execution and never modifies the cached state.
+
+    States of blocks in the chain are loaded by `mk_poststate_of_blockhash`.
+    The state of a block not in the chain, like the pending head candidate, is
+    built once by applying its transactions to the post state of its parent.
+    """
+
+    def __init__(self, chain, size=16):
+        self.chain = chain
+        self.size = size
+        self.states = OrderedDict()  # (hash, state_root): state
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def build(self, block):
+        if self.chain.has_blockhash(block.hash):
+            return self.chain.mk_poststate_of_blockhash(block.hash)
+        state = self.chain.mk_poststate_of_blockhash(block.header.prevhash)
+        initialize(state, block)
+        for tx in block.transactions:
+            apply_transaction(state, tx)
+        state.commit()
+        return state
+
+    def get(self, block):
+        key = (block.hash, block.header.state_root)
+        state = self.states.pop(key, None)
+        if state is None:
+            self.misses += 1
+            state = self.build(block)
+        else:
+            self.hits += 1
+        self.states[key] = state
+        if len(self.states) > self.size:
+            self.states.popitem(last=False)
+        return state
+
+    def view(self, block):
+        "a disposable copy of the post state of block, with no gas used"
+        state = self.get(block).ephemeral_clone()
+        state.gas_used = 0
+        return state
+
+
+class GasEstimator(object):
+
+    """
+    Estimates the gas of a transaction as the least startgas it succeeds with.
+    It is run once with its startgas as cap, then binary searched between the gas
+    used there and the cap, unless it already succeeds with the gas used. Each
+    probe runs on its own copy-on-write clone of the state.
+
+    Results are cached by `(state root, transaction fields)`.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, state, tx, startgas):
+        "returns if tx succeeds with startgas and the gas it used"
+        clone = state.ephemeral_clone()
+        probe_tx = Transaction(tx.nonce, tx.gasprice, startgas, tx.to, tx.value, tx.data)
+        probe_tx.sender = tx.sender
+        try:
+            success, _ = apply_transaction(clone, probe_tx)
+        except InvalidTransaction:
+            return False, 0
+        return bool(success), clone.gas_used - state.gas_used
+
+    def search(self, state, tx):
+        success, gas_used = self.probe(state, tx, tx.startgas)
+        if not success:
+            return None
+        # gas_used is a lower bound, refunds are subtracted after execution
+        if gas_used == tx.startgas or self.probe(state, tx, gas_used)[0]:
+            return gas_used
+        lo, hi = gas_used, tx.startgas  # fails with lo, succeeds with hi
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.probe(state, tx, mid)[0]:
+                hi = mid
+            else:
+                lo = mid
+        return hi
+
+    def estimate(self, state, tx):
+        "returns the gas needed by tx, None if it fails even with its startgas"
+        key = (state.trie.root_hash, tx.sender, tx.to, tx.value, tx.data, tx.gasprice,
+               tx.startgas)
+        if key in self.results:
+            self.hits += 1
+            return self.results[key]
+        self.misses += 1
+        gas = self.results[key] = self.search(state, tx)
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+        return gas
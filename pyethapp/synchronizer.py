@@ -118,12 +118,8 @@ class SyncTask(object):
                     # is left via a break, continue or return statement.
                     del self.header_requests[proto]
 
-                if not blockheaders_batch:
-                    log_st.warn('empty getblockheaders result')
-                    continue
-                if not all(isinstance(bh, BlockHeader) for bh in blockheaders_batch):
-                    log_st.warn('got wrong data type', expected='BlockHeader',
-                                received=type(blockheaders_batch[0]))
+                if not self.valid_blockheaders(proto, blockheaders_batch):
+                    blockheaders_batch = []  # not used if it was the last peer
                     continue
 
                 self.last_proto = proto
@@ -180,6 +176,20 @@ class SyncTask(object):
             log_st.debug('failed to download blockheaders, exit')
             self.exit(success=False)
 
+    def valid_blockheaders(self, proto, blockheaders_batch):
+        "checks the types and, all at once, the seals of the headers received from proto"
+        if not blockheaders_batch:
+            log_st.warn('empty getblockheaders result')
+            return False
+        if not all(isinstance(bh, BlockHeader) for bh in blockheaders_batch):
+            log_st.warn('got wrong data type', expected='BlockHeader',
+                        received=type(blockheaders_batch[0]))
+            return False
+        if not all(self.chainservice.check_seals(blockheaders_batch)):
+            log_st.warn('invalid seal in blockheaders', proto=proto)
+            return False
+        return True
+
     def fetch_blocks(self, blockheaders_chain):
         # fetch blocks (no parallelism here)
         log_st.debug('fetching blocks', num=len(blockheaders_chain))
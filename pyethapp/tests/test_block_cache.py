@@ -0,0 +1,106 @@
+import rlp
+from ethereum.db import EphemDB
+from ethereum.utils import sha3, int_to_big_endian
+
+from pyethapp.block_cache import HeaderCache, BodyCache
+from pyethapp.eth_protocol import ETHProtocol, rlp_list_items, encode_raw_list
+
+
+class HeaderMock(list):
+
+    "an encodable header with number (at index 8), hash and prevhash"
+
+    def __init__(self, number, prevhash, salt=''):
+        fields = [prevhash] + [salt] * 7 + [int_to_big_endian(number)] + [''] * 6
+        super(HeaderMock, self).__init__(fields)
+        self.number = number
+        self.prevhash = prevhash
+        self.hash = sha3(rlp.encode(self))
+
+
+class BlockMock(object):
+
+    def __init__(self, header):
+        self.header = header
+
+
+class ChainMock(object):
+
+    def __init__(self, length):
+        self.db = EphemDB()
+        self.head_hash = ''
+        for i in range(length):
+            self.add_block(HeaderMock(i, self.head_hash))
+
+    def add_block(self, header, transactions=[], uncles=[]):
+        self.db.put(header.hash, rlp.encode([header, transactions, uncles]))
+        self.db.put('block:%d' % header.number, header.hash)
+        self.head_hash = header.hash
+        return BlockMock(header)
+
+    def get_blockhash_by_number(self, number):
+        return self.db.get('block:%d' % number)  # raises KeyError beyond the head
+
+
+def test_rlp_list_items():
+    items = ['', 'a', 'x' * 100, ['b', ['c']]]
+    encoded = rlp.encode(items)
+    raw = rlp_list_items(encoded)
+    assert raw == [rlp.encode(i) for i in items]
+    assert encode_raw_list(raw) == encoded
+
+
+def test_header_cache_range():
+    chain = ChainMock(10)
+    cache = HeaderCache(chain, size=4)
+    headers = [rlp.decode(h) for h in cache.range(2, 3, skip=1)]
+    assert [rlp.sedes.big_endian_int.deserialize(h[8]) for h in headers] == [2, 4, 6]
+    headers = [rlp.decode(h) for h in cache.range(5, 10, reverse=True)]
+    assert [rlp.sedes.big_endian_int.deserialize(h[8]) for h in headers] == [5, 4, 3, 2, 1, 0]
+    assert len(cache) == 4
+    assert cache.range(8, 5) == [cache.get(8), cache.get(9)]
+    assert cache.range(20, 5) == []  # unknown origin
+    assert cache.get(10) is None
+
+
+def test_header_cache_hash_lookup_and_reorg():
+    chain = ChainMock(5)
+    cache = HeaderCache(chain)
+    block3 = chain.get_blockhash_by_number(3)
+    assert cache.number_of(block3) == 3
+    assert cache.number_of('unknown') is None
+
+    # side chain block is not canonical
+    side = HeaderMock(3, chain.get_blockhash_by_number(2), salt='side')
+    chain.db.put(side.hash, rlp.encode([side, [], []]))
+    assert cache.number_of(side.hash) is None
+
+    cache.on_new_head(chain.add_block(HeaderMock(5, chain.head_hash)))
+    assert len(cache) == 2
+
+    # reorg replaces block 3 and up
+    chain.add_block(side)
+    cache.on_new_head(chain.add_block(HeaderMock(4, side.hash, salt='side')))
+    assert len(cache) == 1
+    assert cache.number_of(side.hash) == 3
+    assert cache.number_of(block3) is None
+
+
+def test_blockheaders_raw_payload():
+    headers = [HeaderMock(i, '') for i in range(3)]
+    payload = ETHProtocol.blockheaders.encode_payload([rlp.encode(h) for h in headers])
+    assert payload == rlp.encode(headers)
+
+
+def test_body_cache():
+    chain = ChainMock(2)
+    txs, uncles = [['tx%d' % i, 'data'] for i in range(3)], [HeaderMock(0, '', salt='uncle')]
+    header = chain.add_block(HeaderMock(2, chain.head_hash), txs, uncles).header
+    cache = BodyCache(chain, size=2)
+    assert cache.get(header.hash) == rlp.encode([txs, uncles])
+    assert cache.get('unknown') is None
+    cache.get(chain.get_blockhash_by_number(0))
+    cache.get(chain.get_blockhash_by_number(1))
+    assert len(cache) == 2 and header.hash not in cache.bodies
+    payload = ETHProtocol.blockbodies.encode_payload([cache.get(header.hash)])
+    assert rlp.decode(payload) == [[txs, rlp.decode(rlp.encode(uncles))]]
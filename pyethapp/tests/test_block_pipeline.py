@@ -0,0 +1,182 @@
+import gevent
+import gevent.lock
+import rlp
+from ethereum.db import EphemDB
+from ethereum.refcount_db import RefcountDB
+from ethereum.securetrie import SecureTrie
+from ethereum.trie import Trie, BLANK_ROOT
+from ethereum.utils import sha3
+
+from pyethapp.block_pipeline import BlockPipeline, CommittedReader, StatePrefetcher
+
+
+class HeaderMock(object):
+
+    def __init__(self, hash, prevhash):
+        self.hash = hash
+        self.prevhash = prevhash
+
+
+class BlockMock(object):
+
+    transactions = []
+    transaction_count = 0
+    gas_used = 0
+
+    def __init__(self, header):
+        self.header = header
+
+
+class TransientBlockMock(object):
+
+    newblock_timestamp = 0
+
+    def __init__(self, hash, prevhash):
+        self.header = HeaderMock(hash, prevhash)
+
+    def to_block(self):
+        return BlockMock(self.header)
+
+
+class ChainMock(object):
+
+    head = None
+    db = None
+
+    def __init__(self):
+        self.blocks = ['genesis']
+
+    def has_blockhash(self, blockhash):
+        return blockhash in self.blocks
+
+    def add_block(self, block):
+        gevent.sleep(0.001)
+        self.blocks.append(block.header.hash)
+        return True
+
+
+class ChainServiceMock(object):
+
+    block_queue_size = 16
+
+    def __init__(self):
+        self.chain = ChainMock()
+        self.add_transaction_lock = gevent.lock.Semaphore()
+        self.verified_seals = set()
+        self.added = []
+
+    def gpsec(self, gas_spent=0, elapsed=0):
+        return 0
+
+    def check_header(self, header):
+        return header.hash != 'bad'
+
+    def on_block_added(self, job):
+        self.added.append(job.block.header.hash)
+
+
+def test_pipeline_order():
+    chainservice = ChainServiceMock()
+    pipeline = BlockPipeline(chainservice, queue_size=2, prefetch=False)
+    pipeline.start()
+    prevhash = 'genesis'
+    for i in range(10):
+        pipeline.put(TransientBlockMock('b%d' % i, prevhash), None)
+        prevhash = 'b%d' % i
+    assert 'b9' in pipeline
+    while not pipeline.idle:
+        gevent.sleep(0.001)
+    pipeline.stop()
+    assert chainservice.added == ['b%d' % i for i in range(10)]
+    stats = pipeline.stats()
+    assert stats['execute']['count'] == 10
+    assert stats['execute']['p50'] >= 0.001
+    assert stats['queue_wait']['count'] == 10
+    assert stats['receive']['count'] == 0  # not received as newblock
+
+
+def test_pipeline_drops_invalid():
+    chainservice = ChainServiceMock()
+    pipeline = BlockPipeline(chainservice, prefetch=False)
+    pipeline.start()
+    pipeline.put(TransientBlockMock('genesis', ''), None)  # known
+    pipeline.put(TransientBlockMock('bad', 'genesis'), None)  # fails header check
+    pipeline.put(TransientBlockMock('orphan', 'unknown'), None)  # missing parent
+    pipeline.put(TransientBlockMock('b0', 'genesis'), None)
+    while not pipeline.idle:
+        gevent.sleep(0.001)
+    pipeline.stop()
+    assert chainservice.added == ['b0']
+
+
+def test_pipeline_skips_verified_seals():
+    chainservice = ChainServiceMock()
+    checked = []
+    chainservice.check_header = lambda header: checked.append(header.hash) or True
+    chainservice.verified_seals.add('b0')  # by check_seals
+    pipeline = BlockPipeline(chainservice, prefetch=False)
+    pipeline.start()
+    pipeline.put(TransientBlockMock('b0', 'genesis'), None)
+    pipeline.put(TransientBlockMock('b1', 'b0'), None)
+    while not pipeline.idle:
+        gevent.sleep(0.001)
+    pipeline.stop()
+    assert checked == ['b1']
+    assert chainservice.added == ['b0', 'b1']
+
+
+class CountingDB(EphemDB):
+
+    """
+    Counts the reads around the write cache, the prefetcher must not read
+    through it.
+    """
+
+    def __init__(self):
+        super(CountingDB, self).__init__()
+        self.reads = set()
+        self.cached_reads = 0
+
+    def get(self, key):
+        self.cached_reads += 1
+        return super(CountingDB, self).get(key)
+
+    def get_committed(self, key):
+        self.reads.add(key)
+        return super(CountingDB, self).get(key)
+
+
+def test_state_prefetcher(pruning=False):
+    backend = CountingDB()
+    db = RefcountDB(backend) if pruning else backend
+    code = 'contract code'
+    db.put(sha3(code), code)
+    trie = SecureTrie(Trie(db, BLANK_ROOT))
+    contract = '\x01' * 20
+    trie.update(contract, rlp.encode([0, 0, BLANK_ROOT, sha3(code)]))
+
+    class TxMock(object):
+        _sender = '\x02' * 20
+        to = contract
+
+    class BlockMock(object):
+        header = HeaderMock('b0', 'genesis')
+        header.coinbase = '\x03' * 20
+        transactions = [TxMock()]
+
+    prefetcher = StatePrefetcher(db)
+    assert prefetcher.addresses(BlockMock) == set([contract, TxMock._sender,
+                                                   BlockMock.header.coinbase])
+    backend.cached_reads = 0
+    prefetcher.prefetch(trie.trie.root_hash, BlockMock).get()
+    assert backend.reads and not backend.cached_reads
+    assert (b'r:' + sha3(code) if pruning else sha3(code)) in backend.reads
+
+
+def test_state_prefetcher_pruning():
+    test_state_prefetcher(pruning=True)
+
+
+def test_no_prefetching_from_memory():
+    assert not CommittedReader.supports(EphemDB())
+    assert CommittedReader.supports(RefcountDB(CountingDB()))
@@ -109,3 +109,50 @@ def test_blocks():
     # assert that transactions and uncles have not been decoded
     assert len(_d['block'].transactions) == 0
     assert len(_d['block'].uncles) == 0
+
+
+def test_lazy_transient_block():
+    from ethereum.block import Block, BlockHeader
+    from ethereum.transactions import Transaction
+    tx = Transaction(0, 1, 21000, '\x01' * 20, 1, '').sign('\x02' * 32)
+    block = Block(BlockHeader(number=1), transactions=[tx], uncles=[BlockHeader(number=0)])
+    payload = ETHProtocol.newblock.encode_payload([block, 1000])
+
+    data = ETHProtocol.newblock.decode_payload(payload)
+    t_block = data['block']
+    assert data['chain_difficulty'] == 1000
+    assert t_block.header == block.header
+    assert t_block._transactions is None and t_block._uncles is None  # not decoded yet
+    # relayed as received
+    assert ETHProtocol.newblock.encode_payload([t_block, 1000]) == payload
+    assert t_block._transactions is None
+    assert t_block.transactions[0].hash == tx.hash
+    assert t_block.uncles == (BlockHeader(number=0),)
+    assert t_block.to_block().header.hash == block.header.hash
+
+
+def test_compactblock():
+    from ethereum.block import Block, BlockHeader
+    from ethereum.transactions import Transaction
+    txs = [Transaction(i, 1, 21000, '\x01' * 20, 1, '').sign('\x02' * 32) for i in range(3)]
+    block = Block(BlockHeader(number=1), transactions=txs, uncles=[])
+    t_block = ETHProtocol.newblock.decode_payload(
+        ETHProtocol.newblock.encode_payload([block, 1000]))['block']
+    short_ids = [tx.hash[:ETHProtocol.compactblock.short_id_length] for tx in txs]
+    for b in (block, t_block):
+        header, ids, uncles, chain_difficulty = ETHProtocol.compactblock().create(None, b, 1000)
+        assert header == block.header and ids == short_ids and chain_difficulty == 1000
+    assert t_block._transactions is None  # ids taken from the raw transactions
+
+
+def test_metrics():
+    peer, proto, chain, cb_data, cb = setup()
+    proto.send_getblockheaders(1, 2)
+    packet = peer.packets.pop()
+    proto.receive_getblockheaders_callbacks.append(cb)
+    proto._receive_getblockheaders(packet)
+    assert cb_data.pop()[1]['amount'] == 2
+    commands = proto.metrics.summary()['commands']
+    assert commands['getblockheaders']['sent'] == 1
+    assert commands['getblockheaders']['received'] == 1
+    assert commands['getblockheaders']['bytes_in'] == len(packet.payload)
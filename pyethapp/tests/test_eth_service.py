@@ -1,4 +1,5 @@
 import os
+import gevent
 from pyethapp import monkeypatches
 from ethereum.db import EphemDB
 from pyethapp import eth_service
@@ -7,6 +8,7 @@ from pyethapp import codernitydb_service
 from pyethapp import eth_protocol
 from ethereum import slogging
 from ethereum import config as eth_config
+from ethereum.transactions import Transaction, secpk1n
 import rlp
 import tempfile
 slogging.configure(config_string=':info')
@@ -33,6 +35,8 @@ class AppMock(object):
 
         class peermanager:
 
+            peers = []
+
             @classmethod
             def broadcast(*args, **kwargs):
                 pass
@@ -121,3 +125,176 @@ def test_receive_blocks_256():
 
 def test_receive_blocks_256_leveldb():
     receive_blocks(data256.decode('hex'), leveldb=True)
+
+
+class ProtoMock(object):
+
+    is_stopped = False
+
+    def __init__(self):
+        self.sent = []
+
+    def send_transactions(self, *transactions):
+        self.sent.append(transactions)
+
+    def send_newblock(self, block, chain_difficulty):
+        self.sent.append('newblock')
+
+    def send_newblockhashes(self, *newblockhashes):
+        self.sent.append('newblockhashes')
+
+    def send_compactblock(self, block, chain_difficulty):
+        self.sent.append('compactblock')
+
+
+def test_transaction_batcher():
+    proto = ProtoMock()
+    batcher = eth_service.TransactionBatcher(proto, window=60, max_batch=2)
+    txs = [Transaction(i, 1, 21000, '\x00' * 20, 0, '') for i in range(4)]
+    batcher.mark_known(txs[0].hash)
+    assert not batcher.add(txs[0])  # peer sent it to us
+    assert batcher.add(txs[1])
+    assert not batcher.add(txs[1])
+    assert batcher.add(txs[2])
+    gevent.sleep(0)  # batch full, sent without waiting for the window
+    assert proto.sent == [(txs[1], txs[2])]
+    assert batcher.add(txs[3])
+    assert proto.sent == [(txs[1], txs[2])]
+    batcher.flush()  # window over
+    assert proto.sent == [(txs[1], txs[2]), (txs[3],)]
+    batcher.stop()
+
+
+def test_transaction_batcher_throttle(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(eth_service.time, 'time', lambda: 1000.0)
+    monkeypatch.setattr(eth_service.gevent, 'sleep', sleeps.append)
+    proto = ProtoMock()
+    txs = [Transaction(i, 1, 21000, '\x00' * 20, 0, '') for i in range(5)]
+    size = len(rlp.encode(txs[0]))
+    batcher = eth_service.TransactionBatcher(proto, max_batch=2, max_bytes_per_sec=size * 2)
+    batcher.pending.extend(txs)
+    batcher.flush()
+    assert proto.sent == [tuple(txs[:2]), tuple(txs[2:4]), (txs[4],)]
+    assert sleeps == [1.0, 1.5]  # the first batch is within the allowance
+
+
+def test_broadcast_newblock_to_sqrt_peers():
+    app = AppMock()
+    eth = eth_service.ChainService(app)
+    protos = [ProtoMock() for i in range(9)]
+    for i, proto in enumerate(protos):
+        protocols = {eth_protocol.ETHProtocol: proto}
+        if i < 4:  # both announced the capability
+            protocols[eth_protocol.CompactBlocksProtocol] = None
+        proto.peer = type('PeerMock', (object,), dict(protocols=protocols))()
+    app.services.peermanager.peers = [proto.peer for proto in protos]
+    d = eth_protocol.ETHProtocol.newblock.decode_payload(newblk_rlp.decode('hex'))
+    eth.broadcast_newblock(d['block'], d['chain_difficulty'])
+    sent = [proto.sent for proto in protos]
+    assert len([s for s in sent if s[0] in ('newblock', 'compactblock')]) == 3
+    assert all(s[-1] == 'newblockhashes' for s in sent)  # announced to all
+    assert all(proto.sent[0] != 'compactblock' for proto in protos[4:])
+    assert sent.count(['newblockhashes']) == 6
+
+
+def test_compactblock_hit_rate(monkeypatch):
+    from ethereum.block import BlockHeader
+    app = AppMock()
+    eth = eth_service.ChainService(app)
+    received = []
+    monkeypatch.setattr(eth.synchronizer, 'receive_newblock',
+                        lambda proto, t_block, chain_difficulty: received.append('block'))
+    monkeypatch.setattr(eth.synchronizer, 'receive_newblockhashes',
+                        lambda proto, newblockhashes: received.append('hashes'))
+    compact, other = ProtoMock(), ProtoMock()
+    compact.peer = type('PeerMock', (object,), dict(
+        protocols={eth_protocol.ETHProtocol: compact, eth_protocol.CompactBlocksProtocol: None}))()
+    other.peer = type('PeerMock', (object,), dict(protocols={eth_protocol.ETHProtocol: other}))()
+    header = BlockHeader(number=1)  # no transactions
+    for proto in (compact, other):
+        eth.on_receive_compactblock(proto, header, [], [], 1000)
+    assert received == ['block', 'hashes']  # only an announcement without the capability
+    assert eth.compact_block_stats == dict(rebuilt=1, fetched=1)
+
+
+def test_transaction_decoder():
+    txs = [Transaction(i, 1, 21000, '\x00' * 20, 0, '').sign('\x01' * 32) for i in range(4)]
+    raw = [rlp.encode(tx) for tx in txs]
+    known = set([txs[0].hash])
+    decoder = eth_service.TransactionDecoder(known.__contains__, max_blocking=0)
+    decoded = decoder.decode(raw + [raw[1], 'invalid'])
+    assert [tx.hash for tx in decoded] == [tx.hash for tx in txs[1:]]
+
+
+def test_transaction_validator():
+    key = '\x01' * 32
+
+    class StateMock(object):
+        gas_limit = 100000
+        reads = 0
+        config = eth_config.default_config
+
+        def is_HOMESTEAD(self):
+            return True
+
+        def is_METROPOLIS(self):
+            return False
+
+        def get_nonce(self, address):
+            self.reads += 1
+            return 2
+
+        def get_balance(self, address):
+            return 21000 * 10
+
+    class ChainMock(object):
+        state = StateMock()
+
+    validator = eth_service.TransactionValidator(ChainMock(), max_nonce_gap=4,
+                                                 max_rejects_per_peer=2)
+    txs = [Transaction(nonce, 1, 21000, '\x00' * 20, 0, '').sign(key) for nonce in range(8)]
+    valid = validator.validate_batch(txs)
+    assert [tx.nonce for tx in valid] == [2, 3, 4, 5, 6]
+    assert ChainMock.state.reads == 1
+    expensive = Transaction(2, 11, 21000, '\x00' * 20, 0, '').sign(key)
+    assert validator.validate_batch([expensive]) == []
+
+    peer = object()
+    assert validator.validate_batch(txs, peer) == []  # dropped after two rejects
+    assert validator.rejects[peer] == 2
+    validator.reset()
+    assert len(validator.validate_batch(txs[2:], peer)) == 5
+    assert ChainMock.state.reads == 2
+
+    # a high s value is malleable, the same signature with s negated
+    tx = Transaction(2, 1, 21000, '\x00' * 20, 0, '').sign(key)
+    sender = tx.sender
+    high_s = Transaction(2, 1, 21000, '\x00' * 20, 0, '', 55 - tx.v, tx.r, secpk1n - tx.s)
+    assert high_s.sender == sender
+    assert validator.validate_batch([tx, high_s]) == [tx]
+
+    # only txs continuing the account nonce are broadcast
+    validator.reset()
+    assert [validator.continues_nonce(tx) for tx in txs[2:]] == [True] * 6
+    validator.reset()
+    assert [validator.continues_nonce(tx) for tx in txs[3:]] == [False] * 5
+    assert validator.continues_nonce(txs[2])
+    assert validator.continues_nonce(txs[2])  # a replacement
+    assert validator.continues_nonce(txs[3])
+
+
+def test_check_seals_by_consensus_strategy(monkeypatch):
+    app = AppMock()
+    eth = eth_service.ChainService(app)
+    monkeypatch.setattr(eth_service, 'check_pow_batch', lambda headers: [False] * len(headers))
+    d = eth_protocol.ETHProtocol.newblock.decode_payload(newblk_rlp.decode('hex'))
+    headers = [d['block'].header]
+    monkeypatch.setitem(eth.chain.env.config, 'CONSENSUS_STRATEGY', 'pow')
+    assert eth.check_seals(headers) == [False]
+    assert headers[0].hash not in eth.verified_seals
+    monkeypatch.setattr(eth_service, 'check_pow_batch', lambda headers: [True] * len(headers))
+    assert eth.check_seals(headers) == [True]
+    assert headers[0].hash in eth.verified_seals  # not checked again by the block pipeline
+    monkeypatch.setitem(eth.chain.env.config, 'CONSENSUS_STRATEGY', 'casper')
+    assert eth.check_seals(headers) == [True]  # no PoW seals to check
@@ -0,0 +1,58 @@
+import random
+import struct
+
+import pytest
+from ethereum import ethash, ethash_utils, ethpow
+from ethereum.utils import sha3
+
+from pyethapp import ethash_batch
+
+pytest.importorskip('numpy')
+
+FULL_SIZE = ethash_utils.MIX_BYTES * 101
+
+
+class HeaderMock(object):
+
+    def __init__(self, number, mining_hash, nonce, mixhash, difficulty):
+        self.number = number
+        self.mining_hash = mining_hash
+        self.nonce = nonce
+        self.mixhash = mixhash
+        self.difficulty = difficulty
+
+
+@pytest.fixture
+def small_epoch(monkeypatch):
+    "a tiny cache and dataset, with results comparable to the scalar implementation"
+    random.seed(1)
+    cache = [[random.getrandbits(32) for _ in range(16)] for _ in range(37)]
+    monkeypatch.setattr(ethash_utils, 'get_full_size', lambda block_number: FULL_SIZE)
+    monkeypatch.setattr(ethpow, 'get_cache', lambda block_number: cache)
+    return cache
+
+
+def scalar_hashimoto(cache, mining_hash, nonce):
+    o = ethash.hashimoto(mining_hash, nonce, FULL_SIZE,
+                         lambda i: ethash.calc_dataset_item(cache, i))
+    return o['mix digest'], o['result']
+
+
+def test_hashimoto_batch_matches_scalar(small_epoch):
+    hashes = [sha3(str(i)) for i in range(5)]
+    nonces = [struct.pack('>Q', random.getrandbits(64)) for _ in hashes]
+    outputs = ethash_batch.hashimoto_light_batch(
+        0, ethash_batch.cache_array(small_epoch), hashes, nonces)
+    assert outputs == [scalar_hashimoto(small_epoch, h, n) for h, n in zip(hashes, nonces)]
+
+
+def test_check_pow_batch(small_epoch):
+    headers = []
+    for i in range(4):
+        mining_hash, nonce = sha3(str(i)), struct.pack('>Q', i)
+        mix_digest, _ = scalar_hashimoto(small_epoch, mining_hash, nonce)
+        headers.append(HeaderMock(i, mining_hash, nonce, mix_digest, 1))
+    headers[1].mixhash = '\x00' * 32
+    headers[2].nonce = 'short'
+    headers[3].difficulty = 2**255  # result above target
+    assert ethash_batch.check_pow_batch(headers, chunk_size=2) == [True, False, False, False]
@@ -0,0 +1,71 @@
+import math
+import random
+
+from pyethapp.metrics import LatencyHistogram, ProtocolMetrics, MovingAverage, MiningMetrics
+
+
+def test_latency_histogram_percentiles():
+    random.seed(42)
+    h = LatencyHistogram()
+    values = sorted(random.expovariate(1 / 0.05) for _ in range(10000))
+    for v in values:
+        h.add(v)
+    assert h.count == len(values)
+    assert abs(h.mean - sum(values) / len(values)) < 1e-9
+    assert h.min == values[0] and h.max == values[-1]
+    for pct in (50, 90, 99, 99.9):
+        expected = values[int(len(values) * pct / 100.) - 1]
+        assert abs(h.percentile(pct) - expected) <= expected / 16.
+    assert h.percentile(100) == h.max
+
+
+def test_latency_histogram_bounds():
+    h = LatencyHistogram(max_bits=20)
+    assert h.summary()['p99'] == 0.
+    h.add(0)
+    h.add(1e6)  # beyond the last bucket
+    assert h.percentile(0) == 0
+    assert h.percentile(100) == 1e6
+    assert len(h.counts) == (20 - 4 + 1) * 16
+
+
+def test_protocol_metrics():
+    total = ProtocolMetrics()
+    peers = [ProtocolMetrics(total), ProtocolMetrics(total)]
+    for m in peers:
+        m.on_send('getblockheaders', 10)
+        m.on_receive('blockheaders', 500, 0.01)
+        m.on_receive('blockheaders', 500, 0.01)  # unrequested
+    peers[0].on_send('transactions', 100)
+
+    summary = peers[0].summary()
+    assert summary['commands']['blockheaders'] == dict(received=2, bytes_in=1000, sent=0,
+                                                       bytes_out=0, decode_time=0.02)
+    assert summary['commands']['transactions']['bytes_out'] == 100
+    assert summary['requests']['getblockheaders']['count'] == 1
+    summary = total.summary()
+    assert summary['commands']['blockheaders']['received'] == 4
+    assert summary['commands']['getblockheaders']['sent'] == 2
+    assert summary['requests']['getblockheaders']['count'] == 2
+
+
+def test_moving_average():
+    avg = MovingAverage(tau=10.)
+    avg.add(100, now=0)
+    assert avg.value == 100
+    avg.add(200, now=0)  # no time passed, no weight
+    assert avg.value == 100
+    avg.add(200, now=10)
+    assert abs(avg.value - (200 - 100 / math.e)) < 1e-9
+    avg.add(0, now=1000)
+    assert avg.value < 1e-9
+
+
+def test_mining_metrics():
+    m = MiningMetrics()
+    m.on_hashrate(0, 100)
+    m.on_hashrate(1, 50)
+    m.latency['build'].add(0.5)
+    summary = m.summary()
+    assert summary['hashrate'] == 150 and summary['workers'] == {0: 100, 1: 50}
+    assert summary['latency']['build']['count'] == 1
@@ -1,26 +1,39 @@
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import gevent
 import pytest
 from gevent.event import Event
+from gevent.lock import Semaphore
 
 from devp2p.app import BaseApp
 from devp2p.service import BaseService
-from ethereum import slogging
+from ethereum import ethpow, slogging
 from ethereum.block import Block, BlockHeader
 from ethereum.db import DB
 from ethereum.transaction_queue import TransactionQueue
 
-from pyethapp.pow_service import PoWService
+from pyethapp.pow_service import PoWService, EthashCache
 
 DIFFICULTY = 1024  # Mining difficulty.
 TIMEOUT = 15       # Timeout for single block being minded.
 
 
+class ChainMock(object):
+    head_hash = BlockHeader().prevhash  # the parent of the mocked candidates
+
+
 class ChainServiceMock(BaseService):
     name = 'chain'
 
     def __init__(self, app):
         super(ChainServiceMock, self).__init__(app)
         self.on_new_head_cbs = []
+        self.on_new_transaction_cbs = []
+        self.chain = ChainMock()
         self.transaction_queue = TransactionQueue()
+        self.add_transaction_lock = Semaphore()
         self.is_syncing = False
         self.mined_block = None
         self.block_mined_event = Event()
@@ -54,6 +67,8 @@ def test_pow_default(app):
     assert not pow.active
     assert not app.config['pow']['activated']
     assert app.config['pow']['cpu_pct'] == 100
+    assert pow.num_workers == multiprocessing.cpu_count()
+    assert pow.worker_processes == []  # not before mining
     assert not app.config['pow']['coinbase_hex']
     assert app.config['pow']['mine_empty_blocks']
 
@@ -71,6 +86,7 @@ def test_pow_mine_empty_block(app):
     e.wait(timeout=TIMEOUT)
     assert e.is_set(), "Block has not been mined for {} s".format(TIMEOUT)
     assert chain.mined_block
+    assert len(app.services.pow.worker_processes) == multiprocessing.cpu_count()
 
 
 def test_pow_dont_mine_empty_block(app):
@@ -84,3 +100,116 @@ def test_pow_dont_mine_empty_block(app):
     assert not e.is_set(), "Block has been mined"
     assert chain.mined_block is None
     assert pow.hashrate == 0, "Miner is working"
+    assert pow.worker_processes == []
+
+
+def test_pow_update_candidate(app, monkeypatch):
+    app.config['pow']['mine_empty_blocks'] = False
+    app.config['pow']['candidate_update_delay'] = 0.1
+    app.config['pow']['activated'] = True
+    chain = app.services.chain
+    pow = app.services.pow
+    pow.make_candidate_and_mine()
+    assert pow.head_candidate and len(pow.work) == 0  # empty, not mined
+
+    updated = Block(BlockHeader(difficulty=DIFFICULTY, number=1), db=DB())
+    monkeypatch.setattr(PoWService, 'update_head_candidate', lambda self: updated)
+    for cb in chain.on_new_transaction_cbs:  # several txs, one update
+        cb(None)
+        cb(None)
+    gevent.sleep(0.2)
+    assert pow.candidate_update is None
+    chain.block_mined_event.wait(timeout=TIMEOUT)
+    assert chain.mined_block is updated
+
+
+def test_pow_rebuilds_stale_candidate(app, monkeypatch):
+    app.config['pow']['mine_empty_blocks'] = False
+    app.config['pow']['candidate_update_delay'] = 0.01
+    app.config['pow']['activated'] = True
+    chain = app.services.chain
+    pow = app.services.pow
+    pow.make_candidate_and_mine()
+    stale = pow.head_candidate
+    monkeypatch.setattr(chain.chain, 'head_hash', '\x01' * 32)  # new head while syncing
+    monkeypatch.setattr(PoWService, 'update_head_candidate', lambda self: pytest.fail())
+    rebuilt = Block(BlockHeader(difficulty=DIFFICULTY, prevhash='\x01' * 32), db=DB())
+    monkeypatch.setattr(PoWService, 'make_head_candidate', lambda self: rebuilt)
+    assert pow.candidate_is_stale()
+    for cb in chain.on_new_transaction_cbs:
+        cb(None)
+    gevent.sleep(0.05)
+    assert pow.head_candidate is rebuilt and pow.head_candidate is not stale
+    assert not pow.candidate_is_stale()
+
+
+def test_pow_submit_work(app, monkeypatch):
+    app.config['pow']['mine_empty_blocks'] = False
+    app.config['pow']['activated'] = True
+    chain = app.services.chain
+    pow = app.services.pow
+    jobs = [Block(BlockHeader(difficulty=2**60, number=1, gas_used=i), db=DB()) for i in range(2)]
+    for job in jobs:
+        pow.mine(job)  # too hard for the workers
+    assert pow.work.current is jobs[1]
+
+    valid = []
+    monkeypatch.setattr(ethpow, 'check_pow', lambda *args: valid.append(args) or len(valid) > 1)
+    assert not pow.submit_work('\x01' * 8, '\x02' * 32, '\x03' * 32)  # unknown
+    assert not valid
+    assert not pow.submit_work('\x01' * 8, '\x02' * 32, jobs[0].mining_hash)  # invalid
+    assert pow.submit_work('\x01' * 8, '\x02' * 32, jobs[0].mining_hash)  # replaced job
+    assert valid[-1] == (1, jobs[0].mining_hash, '\x02' * 32, '\x01' * 8, 2**60)
+    assert chain.mined_block is jobs[0] and jobs[0].nonce == '\x01' * 8
+    assert jobs[1].mining_hash not in pow.work
+    stats = pow.stats()
+    assert stats['stale_work'] == 1 and stats['solutions'] == 1
+    assert stats['latency']['submit_to_broadcast']['count'] == 1
+
+
+def test_pow_waits_for_ethash_cache(app, monkeypatch):
+    pow = app.services.pow
+
+    class EthashCacheMock(object):
+        ready = Event()
+        waits = []
+
+        def prepare(self, block_number, wait=True):
+            self.waits.append(wait)
+            if wait:
+                self.ready.wait()
+            return self.ready.is_set()
+
+    pow.ethash_cache = cache = EthashCacheMock()
+    sent = []
+    monkeypatch.setattr(PoWService, 'send_work', lambda self, hc: sent.append(hc))
+    jobs = [Block(BlockHeader(difficulty=DIFFICULTY, gas_used=i), db=DB()) for i in range(2)]
+    for job in jobs:
+        pow.mine(job)  # doesn't block, e.g. in a new head callback
+    assert pow.cache_waiter is not None and not sent
+    cache.ready.set()
+    gevent.sleep(0.01)
+    assert sent == [jobs[1]] and pow.cache_waiter is None
+    assert cache.waits == [False, True]
+
+
+def test_ethash_cache(tmpdir, monkeypatch):
+    items = [[i * 16 + j for j in range(16)] for i in range(8)]
+    monkeypatch.setattr(ethpow, 'mkcache', lambda block_number: items)
+    monkeypatch.setattr(ethpow, 'cache_by_seed', OrderedDict())
+    ethpow.cache_by_seed.max_items = 10
+    cache = EthashCache(str(tmpdir))
+    cache.prepare(1)
+    cache.generate(1, wait=True)  # pregenerated next epoch
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        os.path.basename(cache.path(e)) for e in (0, 1))
+    mapped = ethpow.cache_by_seed[cache.seed(0)]
+    assert len(mapped) == len(items)
+    assert [mapped[i] for i in range(len(items))] == items
+
+    # a new epoch installs the pregenerated cache, old epochs are pruned
+    cache.epochs_kept = 1
+    cache.prepare(ethpow.EPOCH_LENGTH, wait=False)
+    assert cache.seed(1) in ethpow.cache_by_seed
+    assert os.path.basename(cache.path(0)) not in os.listdir(str(tmpdir))
+    cache.generate(2)
@@ -0,0 +1,63 @@
+from ethereum.db import EphemDB
+from ethereum.state_transition import Receipt
+
+from pyethapp.eth_protocol import ETHProtocol
+from pyethapp.receipts import ReceiptsStore
+
+
+class HeaderMock(object):
+
+    def __init__(self, number, hash):
+        self.number = number
+        self.hash = hash
+        self.prevhash = ''
+
+
+class BlockMock(object):
+
+    def __init__(self, number, hash):
+        self.header = HeaderMock(number, hash)
+
+
+class StateMock(object):
+
+    receipts = []
+
+
+class DBMock(EphemDB):
+
+    commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+
+class ChainMock(object):
+
+    head_hash = 'head'
+
+    def __init__(self):
+        self.db = DBMock()
+        self.state = StateMock()
+        self.blocks = dict(genesis=BlockMock(0, 'genesis'))
+
+    def get_block(self, blockhash):
+        return self.blocks.get(blockhash)
+
+
+def test_receipts_store():
+    chain = ChainMock()
+    store = ReceiptsStore(chain)
+    chain.state.receipts = [Receipt('\x01' * 32, 21000 * (i + 1), []) for i in range(3)]
+    store.on_new_head(BlockMock(1, 'side'))  # not the head
+    assert store.get_raw('side', compute=False) is None
+    store.on_new_head(BlockMock(1, 'head'))
+    assert chain.db.commits == 1  # the chain committed the block before
+    receipts = store.get('head')
+    assert [r.gas_used for r in receipts] == [21000, 42000, 63000]
+    assert store.get('genesis') == ()  # computed
+    assert store.get('unknown') is None
+
+    payload = ETHProtocol.receipts.encode_payload([store.get_raw('head'), store.get_raw('genesis')])
+    assert ETHProtocol.receipts.decode_payload(payload) == [store.get_raw('head'),
+                                                            store.get_raw('genesis')]
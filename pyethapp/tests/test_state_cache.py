@@ -0,0 +1,52 @@
+from ethereum.block_creation import make_head_candidate
+from ethereum.chain import Chain
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3, privtoaddr
+
+from pyethapp.state_cache import PostStateCache, GasEstimator
+from pyethapp.tx_pool import TransactionPool
+
+key = sha3('key')
+address = privtoaddr(key)
+# fails unless more than 100000 gas is left: GAS PUSH3 100000 LT PUSH1 10 JUMPI INVALID JUMPDEST STOP
+gas_hungry = '0x5a620186a010600a57fe5b00'
+
+
+def test_post_state_views():
+    chain = Chain(genesis={address: {'balance': 10**18}})
+    cache = PostStateCache(chain, size=2)
+    view = cache.view(chain.head)
+    assert view.get_balance(address) == 10**18 and view.gas_used == 0
+    view.set_balance(address, 0)
+    assert cache.view(chain.head).get_balance(address) == 10**18  # copy on write
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # the pending block is applied on its parent's state once
+    pool = TransactionPool(lambda sender: chain.state.get_nonce(sender))
+    pool.add_transaction(Transaction(0, 1, 21000, '\x44' * 20, 100, '').sign(key))
+    pending = make_head_candidate(chain, pool)
+    view = cache.view(pending)
+    assert view.get_balance('\x44' * 20) == 100 and view.get_nonce(address) == 1
+    cache.view(pending)
+    assert (cache.hits, cache.misses) == (2, 2) and len(cache) == 2
+
+
+def test_gas_estimation():
+    chain = Chain(genesis={address: {'balance': 10**18}, '\x55' * 20: {'code': gas_hungry}})
+    cache = PostStateCache(chain)
+    estimator = GasEstimator()
+
+    def estimate(to):
+        state = cache.view(chain.head)
+        tx = Transaction(state.get_nonce(address), 0, state.gas_limit, to, 0, '')
+        tx.sender = address
+        return estimator.estimate(state, tx), state, tx
+
+    gas, _, _ = estimate('\x44' * 20)
+    assert gas == 21000
+    gas, state, tx = estimate('\x55' * 20)
+    assert estimator.probe(state, tx, gas)[0]
+    assert not estimator.probe(state, tx, gas - 1)[0]
+    assert gas > 100000
+    assert estimate('\x55' * 20)[0] == gas
+    assert (estimator.hits, estimator.misses) == (1, 2)
@@ -0,0 +1,70 @@
+import gevent
+from ethereum.block import BlockHeader
+
+from pyethapp.synchronizer import SyncTask
+
+GENESIS_HASH = '\x00' * 32
+
+
+class ChainMock(object):
+
+    def __init__(self):
+        self.head = BlockHeader(number=0)
+
+    def has_blockhash(self, blockhash):
+        return blockhash == GENESIS_HASH
+
+    def get_block(self, blockhash):
+        return self.head
+
+
+class ChainServiceMock(object):
+
+    config = dict(eth=dict(block=dict(DIFF_ADJUSTMENT_CUTOFF=13)))
+
+    def __init__(self):
+        self.chain = ChainMock()
+
+    def check_seals(self, headers):
+        return [False] * len(headers)
+
+
+class SynchronizerMock(object):
+
+    def __init__(self):
+        self.chainservice = ChainServiceMock()
+        self.chain = self.chainservice.chain
+        self.protocols = []
+        self.exited = []
+
+    def synctask_exited(self, success):
+        self.exited.append(success)
+
+
+class ProtoMock(object):
+
+    is_stopped = False
+    task = None
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.requests = 0
+
+    def send_getblockheaders(self, blockhash, amount):
+        self.requests += 1
+        self.task.header_requests[self].set(self.headers)
+
+
+def test_synctask_drops_headers_with_bad_seal(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(SyncTask, 'retry_delay', 0)
+    monkeypatch.setattr(SyncTask, 'fetch_blocks', lambda self, headers: fetched.append(headers))
+    synchronizer = SynchronizerMock()
+    proto = ProtoMock([BlockHeader(prevhash=GENESIS_HASH, number=1)])
+    synchronizer.protocols.append(proto)  # the only peer
+    proto.task = SyncTask(synchronizer, proto, '\x01' * 32)
+    while not (synchronizer.exited or fetched):
+        gevent.sleep(0.001)
+    assert synchronizer.exited == [False]
+    assert proto.requests == SyncTask.max_retries
+    assert fetched == []
@@ -0,0 +1,133 @@
+import os
+import tempfile
+
+from ethereum.transaction_queue import PRIO_INFINITY
+from ethereum.transactions import Transaction
+from ethereum.utils import sha3, privtoaddr
+
+from pyethapp.tx_pool import TransactionPool, TransactionJournal
+
+keys = [sha3('key%d' % i) for i in range(3)]
+
+
+def make_tx(key, nonce, gasprice, startgas=21000):
+    return Transaction(nonce, gasprice, startgas, '\x35' * 20, 0, '').sign(key)
+
+
+def pop_all(pool, **kwargs):
+    txs = []
+    while True:
+        tx = pool.pop_transaction(**kwargs)
+        if tx is None:
+            return txs
+        txs.append(tx)
+
+
+def test_pop_by_price_in_nonce_order():
+    nonces = dict((privtoaddr(k), 0) for k in keys)
+    pool = TransactionPool(nonces.get)
+    for nonce, price in enumerate([1, 5, 9]):
+        pool.add_transaction(make_tx(keys[0], nonce, price))
+    pool.add_transaction(make_tx(keys[1], 0, 3))
+    pool.add_transaction(make_tx(keys[1], 1, 4))
+    assert len(pool) == 5
+    assert [item.tx.gasprice for item in pool.peek(2)] == [9, 5]
+    assert [(tx.gasprice, tx.nonce) for tx in pop_all(pool)] == \
+        [(3, 0), (4, 1), (1, 0), (5, 1), (9, 2)]
+    assert len(pool) == 0
+
+
+def test_future_queue():
+    nonces = {privtoaddr(keys[0]): 1}
+    pool = TransactionPool(nonces.get)
+    assert not pool.add_transaction(make_tx(keys[0], 0, 1))  # stale
+    pool.add_transaction(make_tx(keys[0], 3, 1))
+    pool.add_transaction(make_tx(keys[0], 2, 1))
+    assert len(pool.future[privtoaddr(keys[0])]) == 2
+    assert pool.pop_transaction() is None
+    pool.add_transaction(make_tx(keys[0], 1, 1))  # fills the gap
+    assert not pool.future
+    assert [tx.nonce for tx in pop_all(pool)] == [1, 2, 3]
+
+
+def test_replace_and_evict():
+    pool = TransactionPool(lambda sender: 0, capacity=3, price_bump=10)
+    pool.add_transaction(make_tx(keys[0], 0, 100))
+    assert not pool.add_transaction(make_tx(keys[0], 0, 105))  # below price bump
+    replacement = make_tx(keys[0], 0, 110)
+    assert pool.add_transaction(replacement)
+    assert len(pool) == 1 and replacement.hash in pool
+
+    pool.add_transaction(make_tx(keys[1], 0, 10))
+    pool.add_transaction(make_tx(keys[1], 1, 50))
+    assert not pool.add_transaction(make_tx(keys[2], 0, 5))  # cheapest, evicted at once
+    assert pool.add_transaction(make_tx(keys[2], 0, 20))
+    assert len(pool) == 3
+    # evicting the tx of keys[1] with nonce 0 leaves nonce 1 behind a gap
+    assert list(pool.future[privtoaddr(keys[1])]) == [1]
+    assert [tx.gasprice for tx in pop_all(pool)] == [110, 20]
+
+
+def test_pop_limits_and_remove_included():
+    nonces = dict((privtoaddr(k), 0) for k in keys)
+    pool = TransactionPool(nonces.get)
+    big = make_tx(keys[0], 0, 50, startgas=1000000)
+    pool.add_transaction(big)
+    pool.add_transaction(make_tx(keys[1], 0, 10))
+    pool.add_transaction(make_tx(keys[2], 0, 1))
+    assert pool.pop_transaction(max_gas=100000).gasprice == 10
+    assert pool.pop_transaction(max_gas=100000, min_gasprice=5) is None
+    assert pool.pop_transaction(max_seek_depth=1).hash == big.hash
+
+    included = [make_tx(keys[1], 1, 10), make_tx(keys[1], 2, 10)]
+    for tx in included:
+        pool.add_transaction(tx)
+    pool.add_transaction(make_tx(keys[1], 3, 10))
+    nonces[privtoaddr(keys[1])] = 3
+    assert pool.diff(included) is pool
+    assert [(tx.gasprice, tx.nonce) for tx in pop_all(pool)] == [(10, 3), (1, 0)]
+
+
+def test_local_transactions_are_not_evicted():
+    pool = TransactionPool(lambda sender: 0, capacity=1)
+    local = make_tx(keys[0], 0, 1)
+    assert pool.add_transaction(local, local=True)
+    assert not pool.add_transaction(make_tx(keys[1], 0, 100))  # nothing to evict but itself
+    assert pool.local_transactions() == [local]
+
+
+def test_restore_popped_transactions():
+    pool = TransactionPool(lambda sender: 0, capacity=2)
+    local, forced = make_tx(keys[0], 0, 1), make_tx(keys[1], 0, 2)
+    pool.add_transaction(local, local=True)
+    pool.add_transaction(forced, force=True)
+    candidate = pop_all(pool)
+    assert len(pool) == 0 and len(pool.popped) == 2
+    pool.restore(candidate)  # not mined
+    assert pool.popped == {}
+    assert pool.local_transactions() == [local]
+    assert pool.by_hash[forced.hash].prio == PRIO_INFINITY
+    assert not pool.add_transaction(make_tx(keys[2], 0, 100))  # nothing to evict but itself
+
+
+def test_journal_replay_and_compact():
+    path = os.path.join(tempfile.mkdtemp(), 'transactions.rlp')
+    journal = TransactionJournal(path)
+    pool = TransactionPool(lambda sender: 0)
+    txs = [make_tx(keys[0], 0, 1), make_tx(keys[1], 0, 1), make_tx(keys[1], 0, 2)]
+    for tx in txs:
+        if pool.add_transaction(tx, local=True):
+            journal.append(tx)
+    pool.add_transaction(make_tx(keys[2], 0, 1))  # remote, not journaled
+    journal.close()
+    with open(path, 'ab') as f:
+        f.write('\xf8\x70garbage')  # truncated record
+
+    journal = TransactionJournal(path)
+    assert [tx.hash for tx in journal.load()] == [tx.hash for tx in txs]
+
+    journal.compact(pool)  # 3 records for 2 local txs
+    assert journal.records == 3
+    assert pool.pop_transaction().hash == txs[2].hash  # into a block candidate
+    journal.compact(pool, force=True)
+    assert [tx.hash for tx in TransactionJournal(path).load()] == [txs[0].hash, txs[2].hash]
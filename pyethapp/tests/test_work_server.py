@@ -0,0 +1,44 @@
+import gevent
+
+from pyethapp.work_server import WorkServer
+
+
+class Job(object):
+
+    def __init__(self, mining_hash):
+        self.mining_hash = mining_hash
+
+
+def test_recent_jobs():
+    work = WorkServer(max_jobs=2)
+    jobs = [Job(str(i) * 32) for i in range(3)]
+    for job in jobs:
+        work.add(job)
+    assert work.current is jobs[2]
+    assert len(work) == 2 and jobs[0].mining_hash not in work
+    assert work.get(jobs[1].mining_hash) is jobs[1]  # replaced jobs are still accepted
+    work.clear()
+    assert work.current is None and work.get(jobs[2].mining_hash) is None
+
+
+def test_wait_for_new_work():
+    work = WorkServer()
+    assert work.wait('', timeout=0.01) is None
+    job = Job('a' * 32)
+    waiters = [gevent.spawn(work.wait, ''), gevent.spawn(work.wait, '', 0.01)]
+    gevent.sleep(0.05)
+    work.add(job)
+    gevent.joinall(waiters, timeout=1)
+    assert [w.value for w in waiters] == [job, None]
+    assert work.wait('', timeout=0) is job  # known work differs
+    assert work.wait(job.mining_hash, timeout=0.01) is None
+
+
+def test_hashrates_expire():
+    work = WorkServer(hashrate_ttl=0.05)
+    work.submit_hashrate('0x01', 100)
+    work.submit_hashrate('0x02', 50)
+    assert work.hashrates() == {'0x01': 100, '0x02': 50} and work.hashrate == 150
+    gevent.sleep(0.06)
+    work.submit_hashrate('0x02', 60)
+    assert work.hashrates() == {'0x02': 60}
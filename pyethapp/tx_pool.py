@@ -0,0 +1,311 @@
+# -*- coding: utf8 -*-
+import heapq
+import os
+
+import rlp
+from ethereum.slogging import get_logger
+from ethereum.transaction_queue import OrderableTx, PRIO_INFINITY
+from ethereum.transactions import Transaction
+
+log = get_logger('eth.txpool')
+
+
+class PoolEntry(OrderableTx):
+
+    "ordered by gas price like the entries of `TransactionQueue`"
+
+    def __init__(self, prio, counter, tx, local=False):
+        super(PoolEntry, self).__init__(prio, counter, tx)
+        self.sender = tx.sender
+        self.local = local
+        self.removed = False
+
+
+class TransactionPool(object):
+
+    """
+    Pending transactions, replaces `ethereum.transaction_queue.TransactionQueue`.
+
+    The transactions of each sender are indexed by nonce. Those continuing the
+    sender's account nonce are pending, the ones behind a nonce gap are queued in
+    `future` until the gap is filled. The gas price heap holds the lowest pending
+    transaction of each sender, so transactions are popped by price but in nonce
+    order.
+
+    A transaction replaces the one of the same sender and nonce if its gas
+    price is at least `price_bump` percent higher. Beyond `capacity` the lowest
+    priced transaction is evicted, forced and local ones are kept. Removed entries are
+    left in the heaps and skipped, so removing k transactions is O(k).
+
+    Popped transactions are remembered until they are included in a block or
+    put back by `restore`, which keeps whether they were forced or local.
+    """
+
+    def __init__(self, get_nonce=None, capacity=4096, price_bump=10):
+        self.get_nonce = get_nonce or (lambda sender: None)
+        self.capacity = capacity
+        self.price_bump = price_bump
+        self.counter = 0
+        self.pending = dict()  # sender: {nonce: entry}
+        self.future = dict()  # sender: {nonce: entry}
+        self.by_hash = dict()
+        self.heap = []  # lowest pending nonce of each sender, by price
+        self.cheapest = []  # (gasprice, counter, entry) of all unforced entries
+        self.popped = dict()  # tx hash: entry, popped for a block candidate
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.by_hash
+
+    @property
+    def txs(self):
+        return self.by_hash.values()
+
+    def local_transactions(self):
+        "by age, including the ones popped for a block candidate"
+        entries = [e for e in self.by_hash.values() + self.popped.values() if e.local]
+        return [e.tx for e in sorted(entries, key=lambda e: e.counter)]
+
+    def _next_nonce(self, sender):
+        "the nonce continuing the pending transactions of sender"
+        pending = self.pending.get(sender)
+        if pending:
+            return max(pending) + 1
+        return self.get_nonce(sender)
+
+    def _head(self, sender):
+        pending = self.pending.get(sender)
+        return pending[min(pending)] if pending else None
+
+    def _insert(self, entry):
+        sender, nonce = entry.sender, entry.tx.nonce
+        next_nonce = self._next_nonce(sender)
+        if next_nonce is None or nonce == next_nonce:
+            is_head = sender not in self.pending
+            self.pending.setdefault(sender, dict())[nonce] = entry
+            if is_head:
+                heapq.heappush(self.heap, entry)
+            self._promote(sender)
+        else:
+            self.future.setdefault(sender, dict())[nonce] = entry
+        self._index(entry)
+
+    def _promote(self, sender):
+        "moves future transactions which became continuous to pending"
+        future = self.future.get(sender)
+        nonce = self._next_nonce(sender)
+        while future and nonce in future:
+            self.pending[sender][nonce] = future.pop(nonce)
+            nonce += 1
+        if not future:
+            self.future.pop(sender, None)
+
+    def _index(self, entry):
+        self.by_hash[entry.tx.hash] = entry
+        if entry.prio != PRIO_INFINITY and not entry.local:
+            heapq.heappush(self.cheapest, (entry.tx.gasprice, entry.counter, entry))
+
+    def _remove(self, entry, included=False):
+        """
+        removes entry. Unless it was included in a block, the pending
+        transactions of its sender behind it are moved to the future queue.
+        """
+        entry.removed = True
+        del self.by_hash[entry.tx.hash]
+        sender, nonce = entry.sender, entry.tx.nonce
+        future = self.future.get(sender)
+        if future and future.get(nonce) is entry:
+            del future[nonce]
+            if not future:
+                del self.future[sender]
+            return
+        pending = self.pending[sender]
+        was_head = nonce == min(pending)
+        del pending[nonce]
+        if not included:
+            for n in [n for n in pending if n > nonce]:  # behind a gap now
+                self.future.setdefault(sender, dict())[n] = pending.pop(n)
+        if not pending:
+            del self.pending[sender]
+        elif was_head:
+            heapq.heappush(self.heap, self._head(sender))
+
+    def add_transaction(self, tx, force=False, local=False):
+        "returns True if tx was added to the pool"
+        if tx.hash in self.by_hash:
+            return False
+        account_nonce = self.get_nonce(tx.sender)
+        if account_nonce is not None and tx.nonce < account_nonce:
+            log.debug('stale tx', tx=tx, account_nonce=account_nonce)
+            return False
+        pending = self.pending.get(tx.sender, {})
+        slots = pending if tx.nonce in pending else self.future.get(tx.sender, {})
+        old = slots.get(tx.nonce)
+        if old and not force and tx.gasprice * 100 < old.tx.gasprice * (100 + self.price_bump):
+            log.debug('underpriced replacement', tx=tx)
+            return False
+        entry = PoolEntry(PRIO_INFINITY if force else -tx.gasprice, self.counter, tx, local)
+        self.counter += 1
+        if old:  # takes the slot of old
+            old.removed = True
+            del self.by_hash[old.tx.hash]
+            slots[tx.nonce] = entry
+            self._index(entry)
+            if slots is pending and tx.nonce == min(pending):
+                heapq.heappush(self.heap, entry)
+        else:
+            self._insert(entry)
+        self.evict()
+        return not entry.removed
+
+    def evict(self):
+        while len(self.by_hash) > self.capacity and self.cheapest:
+            _, _, entry = heapq.heappop(self.cheapest)
+            if not entry.removed:
+                log.debug('evicting tx', tx=entry.tx)
+                self._remove(entry)
+
+    def pop_transaction(self, max_gas=9999999999, max_seek_depth=16, min_gasprice=0):
+        "removes and returns the best priced pending tx with `startgas <= max_gas`"
+        skipped = []
+        found = None
+        while self.heap and len(skipped) < max_seek_depth:
+            entry = heapq.heappop(self.heap)
+            if entry.removed or entry is not self._head(entry.sender):
+                continue
+            account_nonce = self.get_nonce(entry.sender)
+            if account_nonce is not None and entry.tx.nonce < account_nonce:
+                self._remove(entry, included=True)  # included meanwhile
+                continue
+            if entry.tx.startgas > max_gas:
+                skipped.append(entry)
+            elif entry.tx.gasprice >= min_gasprice or entry.prio == PRIO_INFINITY:
+                found = entry
+                break
+            else:
+                skipped.append(entry)
+                break  # all others are cheaper
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        if found:
+            self._remove(found, included=True)
+            self.popped[found.tx.hash] = found
+            return found.tx
+
+    def restore(self, transactions):
+        """
+        puts back the transactions of a block candidate that was not mined, as
+        they were added. Other popped transactions were not valid and are dropped.
+        """
+        for tx in transactions:
+            entry = self.popped.pop(tx.hash, None)
+            if entry:
+                self.add_transaction(tx, force=entry.prio == PRIO_INFINITY, local=entry.local)
+            else:
+                self.add_transaction(tx)
+        self.popped.clear()
+
+    def peek(self, num=None):
+        "the pending entries by priority"
+        entries = sorted(e for txs in self.pending.values() for e in txs.values())
+        return entries[:num] if num else entries
+
+    def remove(self, transactions):
+        "removes the transactions included in a block"
+        for tx in transactions:
+            self.popped.pop(tx.hash, None)
+            entry = self.by_hash.get(tx.hash)
+            if entry:
+                self._remove(entry, included=True)
+        for sender in set(tx.sender for tx in transactions):
+            self._drop_stale(sender)
+
+    def _drop_stale(self, sender):
+        "drops transactions below the account nonce of sender"
+        account_nonce = self.get_nonce(sender)
+        if account_nonce is None:
+            return
+        for txs in (self.pending.get(sender, {}), self.future.get(sender, {})):
+            for nonce in [n for n in txs if n < account_nonce]:
+                entry = txs[nonce]
+                if not entry.removed:
+                    self._remove(entry, included=True)
+        if sender not in self.pending:
+            self._promote_future_head(sender)
+
+    def _promote_future_head(self, sender):
+        "starts a pending run from the future queue if it continues the account nonce"
+        future = self.future.get(sender)
+        account_nonce = self.get_nonce(sender)
+        if future and account_nonce in future:
+            entry = future.pop(account_nonce)
+            self.pending[sender] = {account_nonce: entry}
+            heapq.heappush(self.heap, entry)
+            self._promote(sender)
+
+    def diff(self, transactions):
+        "`TransactionQueue` compatible, removes in place"
+        self.remove(transactions)
+        return self
+
+
+class TransactionJournal(object):
+
+    """
+    Append-only file of the local transactions added to the pool, replayed on
+    startup. `compact` rewrites the file with the local transactions of the pool
+    once it holds more than `max_ratio` records per local tx.
+    """
+
+    def __init__(self, path, max_ratio=2):
+        self.path = path
+        self.max_ratio = max_ratio
+        self.records = 0
+        self.file = None
+
+    def load(self):
+        "returns the journaled transactions, skipping a truncated tail"
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        txs = []
+        pos = 0
+        while pos < len(data):
+            try:
+                _, length, start = rlp.codec.consume_length_prefix(data, pos)
+                txs.append(rlp.decode(data[pos:start + length], Transaction))
+            except Exception as e:
+                log.warn('corrupt tx journal record', path=self.path, pos=pos, error=e)
+                break
+            pos = start + length
+        self.records = len(txs)
+        return txs
+
+    def append(self, tx):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(rlp.encode(tx))
+        self.file.flush()
+        self.records += 1
+
+    def compact(self, pool, force=False):
+        "rewrites the journal with the local transactions of pool"
+        txs = pool.local_transactions()
+        if not force and self.records <= self.max_ratio * max(len(txs), 1):
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for tx in txs:
+                f.write(rlp.encode(tx))
+        self.close()
+        os.rename(tmp_path, self.path)
+        log.debug('compacted tx journal', records=self.records, local=len(txs))
+        self.records = len(txs)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -1,6 +1,5 @@
 import time
-import random
-import gevent
+from gevent.event import Event
 from devp2p.service import BaseService
 from ethereum.slogging import get_logger
 from ethereum.utils import privtoaddr, remove_0x_head, encode_hex, decode_hex, sha3
@@ -18,9 +17,44 @@ global_block_counter = 0
 
 casper_ct = get_casper_ct()
 
+
+class CasperCallCache(object):
+
+    """
+    Results of casper contract calls, and of the `casper_utils` functions
+    built on them, keyed by `(state root, function, args)`. Cleared on each
+    new head to bound its size.
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.results = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fun, args, compute):
+        key = (self.chain.state.trie.root_hash, fun, tuple(args))
+        if key in self.results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.results[key] = compute()
+        return self.results[key]
+
+    def clear(self):
+        self.results.clear()
+
+
 class ValidatorService(BaseService):
 
+    """
+    Makes a block when it is our turn. The service sleeps until the next skip
+    timestamp, the timestamp of the earliest block queued by the chain, a new
+    head or a newly queued block, whichever comes first.
+    """
+
     name = 'validator'
+    max_idle = 10.  # seconds, re-checks the activation
     default_config = dict(validator=dict(
         activated=False,
         privkey='',
@@ -54,20 +88,29 @@ class ValidatorService(BaseService):
 
         self.next_skip_count = 0
         self.next_skip_timestamp = 0
+        self.casper_calls = CasperCallCache(self.chain)
         self.epoch_length = self.call_casper('getEpochLength')
         self.active = False
         self.activated = self.app.config['validator']['activated']
 
+        self.wakeup = Event()
         app.services.chain.on_new_head_cbs.append(self.on_new_head)
+        app.services.chain.on_block_queued_cbs.append(self.on_block_queued)
         self.update_activity_status()
         self.cached_head = self.chain.head_hash
 
     def on_new_head(self, block):
+        self.casper_calls.clear()
         if not self.activated:
             return
         if self.app.services.chain.is_syncing:
             return
         self.update()
+        self.wakeup.set()
+
+    def on_block_queued(self, block):
+        if self.activated:
+            self.wakeup.set()
 
     def update_activity_status(self):
         start_epoch = self.call_casper('getStartEpoch', [self.validation_code_hash])
@@ -76,47 +119,62 @@ class ValidatorService(BaseService):
         if start_epoch <= now_epoch < end_epoch:
             self.active = True
             self.next_skip_count = 0
-            self.next_skip_timestamp = get_timestamp(self.chain, self.next_skip_count)
+            self.next_skip_timestamp = self.get_timestamp(self.next_skip_count)
         else:
             self.active = False
 
     def tick(self):
-        delay = 0
-        # Try to create a block
+        "makes a block if it is our turn"
         # Conditions:
         # (i) you are an active validator,
         # (ii) you have not yet made a block with this parent
-        if self.active and self.chain.head_hash not in self.used_parents:
-            t = time.time()
-            # Is it early enough to create the block?
-            if t >= self.next_skip_timestamp and (not self.chain.head or t > self.chain.head.header.timestamp):
-                # Wrong validator; in this case, just wait for the next skip count
-                if not check_skips(self.chain, self.validation_code_hash, self.next_skip_count):
-                    self.next_skip_count += 1
-                    self.next_skip_timestamp = get_timestamp(self.chain, self.next_skip_count)
-                    log.debug('Not my turn, wait',
-                              next_skip_count=self.next_skip_count,
-                              next_skip_timestamp=self.next_skip_timestamp,
-                              now=int(time.time()))
-                    return
-                self.used_parents[self.chain.head_hash] = True
-                blk = self.make_block()
-                assert blk.timestamp >= self.next_skip_timestamp
-                if self.chainservice.add_mined_block(blk):
-                    self.received_objects[blk.hash] = True
-                    log.debug('0x%s made and added block %d (%s) to chain' % (encode_hex(self.address[:8]), blk.header.number, encode_hex(blk.header.hash[:8])))
-                else:
-                    log.debug('0x%s failed to make and add block %d (%s) to chain' % (encode_hex(self.address[:8]), blk.header.number, encode_hex(blk.header.hash[:8])))
-                self.update()
-            else:
-                delay = max(self.next_skip_timestamp - t, 0)
-        # Sometimes we received blocks too early or out of order;
-        # run an occasional loop that processes these
-        if random.random() < 0.02:
+        if not self.active or self.chain.head_hash in self.used_parents:
+            return
+        # Is it early enough to create the block?
+        if time.time() < self.next_block_time():
+            return
+        # Wrong validator; in this case, just wait for the next skip count
+        if not self.check_skips(self.next_skip_count):
+            self.next_skip_count += 1
+            self.next_skip_timestamp = self.get_timestamp(self.next_skip_count)
+            log.debug('Not my turn, wait',
+                      next_skip_count=self.next_skip_count,
+                      next_skip_timestamp=self.next_skip_timestamp,
+                      now=int(time.time()))
+            return
+        self.used_parents[self.chain.head_hash] = True
+        blk = self.make_block()
+        assert blk.timestamp >= self.next_skip_timestamp
+        if self.chainservice.add_mined_block(blk):
+            self.received_objects[blk.hash] = True
+            log.debug('0x%s made and added block %d (%s) to chain' % (
+                encode_hex(self.address[:8]), blk.header.number, encode_hex(blk.header.hash[:8])))
+        else:
+            log.debug('0x%s failed to make and add block %d (%s) to chain' % (
+                encode_hex(self.address[:8]), blk.header.number, encode_hex(blk.header.hash[:8])))
+        self.update()
+
+    def next_block_time(self):
+        "the block must be later than the next skip timestamp and the head"
+        if self.chain.head:
+            return max(self.next_skip_timestamp, self.chain.head.header.timestamp + 0.01)
+        return self.next_skip_timestamp
+
+    def process_queues(self):
+        "adds the blocks received too early or out of order which are due now"
+        with self.chainservice.add_transaction_lock:
             self.chain.process_time_queue()
             self.chain.process_parent_queue()
-            self.update()
-        return delay
+        self.update()
+
+    def next_wakeup(self):
+        "seconds until the next block time or the earliest block queued by the chain"
+        times = [time.time() + self.max_idle]
+        if self.active and self.chain.head_hash not in self.used_parents:
+            times.append(self.next_block_time())
+        if self.chain.time_queue:
+            times.append(self.chain.time_queue[0].timestamp)
+        return max(min(times) - time.time(), 0)
 
     def make_block(self):
         pre_dunkle_count = self.call_casper('getTotalDunklesIncluded')
@@ -140,7 +198,7 @@ class ValidatorService(BaseService):
             self.update_activity_status()
         if self.active:
             self.next_skip_count = 0
-            self.next_skip_timestamp = get_timestamp(self.chain, self.next_skip_count)
+            self.next_skip_timestamp = self.get_timestamp(self.next_skip_count)
         log.debug('Head changed: %s, will attempt creating a block at %d' % (self.chain.head_hash.encode('hex'), self.next_skip_timestamp))
 
     def withdraw(self, gasprice=20 * 10**9):
@@ -156,13 +214,25 @@ class ValidatorService(BaseService):
                          ct.encode('deposit', [self.validation_code, self.randao.get(9999)]))
 
     def call_casper(self, fun, args=[]):
-        return call_casper(self.chain.state, fun, args)
+        return self.casper_calls.get(fun, args, lambda: call_casper(self.chain.state, fun, args))
+
+    def check_skips(self, skips):
+        return self.casper_calls.get('check_skips', [skips], lambda: check_skips(
+            self.chain, self.validation_code_hash, skips))
+
+    def get_timestamp(self, skips):
+        return self.casper_calls.get('get_timestamp', [skips], lambda: get_timestamp(
+            self.chain, skips))
 
     def _run(self):
         while True:
+            self.wakeup.clear()
             if self.activated:
-                delay = self.tick()
-                gevent.sleep(delay)
+                self.process_queues()
+                self.tick()
+                self.wakeup.wait(self.next_wakeup())
+            else:
+                self.wakeup.wait(self.max_idle)
 
     def stop(self):
         super(ValidatorService, self).stop()
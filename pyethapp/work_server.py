@@ -0,0 +1,77 @@
+# -*- coding: utf8 -*-
+import time
+from collections import OrderedDict
+
+import gevent
+from gevent.event import Event
+from ethereum.slogging import get_logger
+
+log = get_logger('pow.work')
+
+
+class WorkServer(object):
+
+    """
+    Work for the local mining processes and for external miners.
+
+    Jobs are the recent versions of the head candidate, keyed by mining hash.
+    Solutions are accepted for any of them, so a miner working on a job
+    replaced by an updated candidate does not lose its solution. Jobs are
+    dropped on a new head.
+
+    Miners waiting in `wait` are woken up by each new job. Hashrates reported
+    by external miners expire after `hashrate_ttl` seconds.
+    """
+
+    def __init__(self, max_jobs=16, hashrate_ttl=10):
+        self.max_jobs = max_jobs
+        self.hashrate_ttl = hashrate_ttl
+        self.jobs = OrderedDict()  # mining_hash: block
+        self.current = None
+        self.new_work = Event()  # replaced by a new one on each new job
+        self.miner_hashrates = dict()  # miner_id: (hashrate, timestamp)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, mining_hash):
+        return mining_hash in self.jobs
+
+    def add(self, block):
+        self.jobs[block.mining_hash] = block
+        while len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+        self.current = block
+        event, self.new_work = self.new_work, Event()
+        event.set()
+
+    def get(self, mining_hash):
+        return self.jobs.get(mining_hash)
+
+    def clear(self):
+        self.jobs.clear()
+        self.current = None
+
+    def wait(self, known_hash=None, timeout=None):
+        "the current job once its mining hash differs from known_hash, None on timeout"
+        with gevent.Timeout(timeout, False):
+            while self.current is None or self.current.mining_hash == known_hash:
+                self.new_work.wait()
+        if self.current is not None and self.current.mining_hash != known_hash:
+            return self.current
+
+    def submit_hashrate(self, miner_id, hashrate):
+        self.miner_hashrates[miner_id] = (hashrate, time.time())
+
+    def hashrates(self):
+        "the hashrates recently reported by external miners"
+        now = time.time()
+        for miner_id, (_, ts) in self.miner_hashrates.items():
+            if now - ts > self.hashrate_ttl:
+                del self.miner_hashrates[miner_id]
+        return dict((miner_id, hashrate)
+                    for miner_id, (hashrate, _) in self.miner_hashrates.items())
+
+    @property
+    def hashrate(self):
+        return sum(self.hashrates().values())
@@ -85,6 +85,9 @@ setup(
     ],
     cmdclass={'test': PyTest},
     install_requires=INSTALL_REQUIRES,
+    extras_require={
+        'numpy': ['numpy'],  # checks ethash seals in batches, see pyethapp/ethash_batch.py
+    },
     dependency_links=DEPENDENCY_LINKS,
     tests_require=[
         'ethereum-serpent>=1.8.1',